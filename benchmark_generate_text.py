@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import functools
+import itertools
+import tracemalloc
+import collections
+
+import generate_text as gt
+
+# the charset sizes of chi_sim/chi_tra v3, chi_sim/chi_tra LSTM and chi_all
+CHARSET_SIZES = (7000, 8000, 10000)
+CJK_RANGE = (0x4E00, 0x9FFF)
+
+
+def make_tables(char_count, successors=40, seed=12345):
+    # random tables in the format of load_wordlist, with zipf distributed
+    # character frequencies
+    rnd = random.Random('%s-%d-%d' % (seed, char_count, successors))
+    chars = [chr(x) for x in rnd.sample(range(*CJK_RANGE), char_count)]
+    weights = [1 / (i + 1) for i in range(char_count)]
+    cum_weights = tuple(itertools.accumulate(weights))
+    # the end of a word, and punctuations after a character
+    extra = [''] + sorted(gt.LEFT_MID_PUNCTS)
+    total1 = cum_weights[-1]
+    freq1 = {ch: w / total1 for ch, w in zip(chars, weights)}
+    freq2 = {}
+    total2 = 0
+    for ch, w in zip(chars, weights):
+        count = rnd.randint(1, successors * 2 - 1)
+        words = dict.fromkeys(rnd.choices(chars, cum_weights=cum_weights, k=count))
+        words.update(dict.fromkeys(rnd.sample(extra, 2)))
+        wl2 = []
+        for word2 in words:
+            freq = w * rnd.paretovariate(1.2)
+            wl2.append((word2, freq))
+            total2 += freq
+        freq2[ch] = wl2
+    for word1, wl2 in freq2.items():
+        freq2[word1] = [(word2, freq / total2) for word2, freq in wl2]
+    return freq1, freq2
+
+
+class PhaseTimer:
+    # accumulates the time spent in methods of an instance
+    def __init__(self):
+        self.seconds = collections.Counter()
+        self.calls = collections.Counter()
+        self.chars = collections.Counter()
+
+    def wrap(self, obj, name):
+        fn = getattr(obj, name)
+
+        @functools.wraps(fn)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.seconds[name] += time.perf_counter() - start
+                self.calls[name] += 1
+
+        setattr(obj, name, timed)
+
+    def wrap_iter(self, obj, name):
+        # only counts the time to produce the items
+        fn = getattr(obj, name)
+
+        @functools.wraps(fn)
+        def timed(*args, **kwargs):
+            it = fn(*args, **kwargs)
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(it)
+                except StopIteration:
+                    self.seconds[name] += time.perf_counter() - start
+                    return
+                self.seconds[name] += time.perf_counter() - start
+                self.calls[name] += 1
+                self.chars[name] += len(item)
+                yield item
+
+        setattr(obj, name, timed)
+
+    def report(self):
+        result = {}
+        for name in self.seconds:
+            result[name] = {
+                'seconds': round(self.seconds[name], 6),
+                'calls': self.calls[name]
+            }
+            if name in self.chars:
+                result[name]['chars'] = self.chars[name]
+        return result
+
+
+def peak_memory(fn, *args):
+    tracemalloc.start()
+    try:
+        fn(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_text_generator(tables, add_words, eng_words, length, repeat, seed):
+    freq1, freq2 = tables
+    result = {'generator': 'TextGenerator', 'length': length}
+    best = None
+    for i in range(repeat):
+        random.seed(seed)
+        start = time.perf_counter()
+        tg = gt.TextGenerator(freq1, freq2, add_words, eng_words)
+        init_time = time.perf_counter() - start
+        start = time.perf_counter()
+        words = list(tg.iter_words(length))
+        gen_time = time.perf_counter() - start
+        start = time.perf_counter()
+        lines = list(gt.WRAPPER.wrap_iter(words, 40))
+        wrap_time = time.perf_counter() - start
+        if best is None or init_time + gen_time + wrap_time < sum(best):
+            best = (init_time, gen_time, wrap_time)
+    init_time, gen_time, wrap_time = best
+    result['init_seconds'] = round(init_time, 6)
+    result['generate_seconds'] = round(gen_time, 6)
+    result['wrap_seconds'] = round(wrap_time, 6)
+    result['seconds'] = round(sum(best), 6)
+    result['tokens'] = len(words)
+    result['output_chars'] = sum(map(len, lines)) + len(lines) - 1
+    result['lines'] = len(lines)
+    result['tokens_per_sec'] = round(len(words) / gen_time, 1)
+    result['chars_per_sec'] = round(result['output_chars'] / sum(best), 1)
+
+    # the phases are timed in a separate run, as the timers add overhead
+    random.seed(seed)
+    tg = gt.TextGenerator(freq1, freq2, add_words, eng_words)
+    timer = PhaseTimer()
+    for name in ('get_next_word', 'get_char', 'has_space'):
+        timer.wrap(tg, name)
+    for name in ('fill_words', 'cover_words'):
+        timer.wrap_iter(tg, name)
+    for word in tg.iter_words(length):
+        pass
+    result['phases'] = timer.report()
+
+    def run():
+        random.seed(seed)
+        gt.TextGenerator(freq1, freq2, add_words, eng_words).generate_text(length)
+
+    result['peak_memory'] = peak_memory(run)
+    return result
+
+
+def bench_legacy(tables, add_words, eng_words, length, repeat, seed):
+    freq1 = list(tables[0].items())
+    freq2 = tables[1]
+    # the legacy generator needs a non-empty additional list
+    add_words = add_words or eng_words
+    result = {'generator': 'legacy', 'length': length}
+    best = None
+    for i in range(repeat):
+        random.seed(seed)
+        start = time.perf_counter()
+        text = gt.generate_text(freq1, freq2, add_words, eng_words, length)
+        seconds = time.perf_counter() - start
+        if best is None or seconds < best:
+            best = seconds
+    result['seconds'] = round(best, 6)
+    result['output_chars'] = len(text)
+    result['chars_per_sec'] = round(len(text) / best, 1)
+
+    def run():
+        random.seed(seed)
+        gt.generate_text(freq1, freq2, add_words, eng_words, length)
+
+    result['peak_memory'] = peak_memory(run)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the synthetic text generator with random '
+        'bigram tables, and print the results as JSON.')
+    parser.add_argument('-c', '--chars', type=int, nargs='+',
+        default=CHARSET_SIZES, help='Charset sizes of the bigram tables')
+    parser.add_argument('-b', '--bigrams', type=int, default=40,
+        help='Average number of bigrams for each character')
+    parser.add_argument('-l', '--length', type=int, nargs='+',
+        default=(50000, 250000), help='Length of generated text')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+        help='Number of timed runs, the fastest is reported')
+    parser.add_argument('--legacy', action='store_true',
+        help='Also benchmark the legacy generate_text()')
+    parser.add_argument('--seed', type=int, default=12345,
+        help='Random seed')
+    parser.add_argument('--eng-words',
+        default='wordlist/google-10000-english.txt',
+        help='English word list')
+    parser.add_argument('--add-words', help='Additional word list')
+    parser.add_argument('-o', '--output', help='Output file')
+    args = parser.parse_args()
+
+    eng_words = gt.load_simplewordlist(args.eng_words)
+    add_words = []
+    if args.add_words:
+        add_words = gt.load_simplewordlist(args.add_words)
+    results = []
+    for char_count in args.chars:
+        start = time.perf_counter()
+        tables = make_tables(char_count, args.bigrams, args.seed)
+        table_info = {
+            'chars': char_count,
+            'bigrams': sum(map(len, tables[1].values())),
+            'tables_seconds': round(time.perf_counter() - start, 6),
+        }
+        for length in args.length:
+            result = bench_text_generator(
+                tables, add_words, eng_words, length, args.repeat, args.seed)
+            results.append(dict(table_info, **result))
+            print('%(generator)s chars=%(chars)d length=%(length)d: '
+                '%(seconds).3fs' % results[-1], file=sys.stderr)
+            if args.legacy:
+                result = bench_legacy(
+                    tables, add_words, eng_words, length, args.repeat, args.seed)
+                results.append(dict(table_info, **result))
+                print('%(generator)s chars=%(chars)d length=%(length)d: '
+                    '%(seconds).3fs' % results[-1], file=sys.stderr)
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'seed': args.seed,
+        'repeat': args.repeat,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+
+import re
+
+WHITESPACE_RE = re.compile('[\t\n\x0b\x0c\r]')
+
+
+class CJKWrapper:
+    # Replacement of a textwrap.TextWrapper splitting the text into chunks:
+    #   whitespace | [left]*[Han][right]* | [¥$+-]*number | other text
+    # Each line is found with two regex matches instead of a Python step
+    # per chunk, lines are kept as (start, end) offsets into the text, and
+    # the width is given per call.
+    def __init__(self, left_puncts, right_puncts, number_prefix='¥$+-'):
+        left, right, prefix = map(re.escape, (
+            left_puncts, right_puncts, number_prefix))
+        han = r'[%s]*[\u4e00-\u9FFF]' % left
+        number = r'[%s]*\d' % prefix
+        chunk = r'(?:\s+|%s[%s]*|%s+(?:\.\d+)?(?:e[+-]\d+)?|(?:(?!\s|%s|%s).)+)' % (
+            han, right, number, han, number)
+        self.chunk_re = re.compile(chunk, re.S)
+        # a run of chunks, group 1 is the last one
+        self.chunks_re = re.compile(r'(?:(%s))*' % chunk, re.S)
+
+    def last_chunk(self, text, pos, endpos):
+        # start of the last chunk in text[pos:endpos] with the text cut at
+        # endpos, and the real end of that chunk
+        start = self.chunks_re.match(text, pos, endpos).start(1)
+        end = self.chunk_re.match(text, start).end()
+        if end <= endpos and start > pos and text[start] in '.e':
+            # a number cut at endpos leaves the rest of it as another chunk
+            prev = self.chunks_re.match(text, pos, start).start(1)
+            prev_end = self.chunk_re.match(text, prev).end()
+            if prev_end > start:
+                return prev, prev_end
+        return start, end
+
+    def _wrap_spans(self, text, width, has_lines=False, skip=0):
+        # Same result as TextWrapper._wrap_chunks with the default options.
+        # Returns (line start, line end, start of its first chunk) and the
+        # start of the last chunk. The text starts with a chunk and the part
+        # before skip is already wrapped.
+        if width <= 0:
+            raise ValueError("invalid width %r (must be > 0)" % width)
+        spans = []
+        length = len(text)
+        pos = skip
+        # chunk split between lines
+        chunk_start = chunk_end = 0
+        if skip:
+            chunk_end = self.chunk_re.match(text).end()
+        while pos < length:
+            if pos >= chunk_end:
+                chunk_start = chunk_end = pos
+            if has_lines and text[pos].isspace():
+                # drop whitespace at the beginning of lines
+                if chunk_end <= pos:
+                    chunk_end = self.chunk_re.match(text, pos).end()
+                pos = chunk_start = chunk_end
+                continue
+            line_start = pos
+            line_chunk = chunk_start
+            max_end = pos + width
+            if max_end >= length:
+                line_end = pos = length
+            else:
+                if chunk_end > max_end:
+                    start, end = chunk_start, chunk_end
+                elif chunk_end == max_end:
+                    start = end = max_end
+                else:
+                    start, end = self.last_chunk(
+                        text, max(pos, chunk_end), max_end)
+                if end <= max_end:
+                    # the line is full before the next chunk
+                    start = end
+                    end = self.chunk_re.match(text, start).end()
+                if end - start <= width:
+                    line_end = pos = start
+                else:
+                    # break long words
+                    split = max(start, pos)
+                    cut = max_end - split
+                    hyphen = text.rfind('-', split, max_end)
+                    if hyphen > split and text[split:hyphen].strip('-'):
+                        cut = hyphen - split + 1
+                    pos = split + cut
+                    chunk_start, chunk_end = start, end
+                    if cut and not text[split].isspace():
+                        line_end = pos
+                    else:
+                        line_end = split
+                    if line_end > line_start:
+                        spans.append((line_start, line_end, line_chunk))
+                        has_lines = True
+                    continue
+            if text[line_end-1].isspace():
+                # drop whitespace at the end of lines
+                line_end = line_start + len(text[line_start:line_end].rstrip())
+            if line_end > line_start:
+                spans.append((line_start, line_end, line_chunk))
+                has_lines = True
+        last_start = spans[-1][2] if spans else 0
+        if last_start < length:
+            last_start = self.last_chunk(text, last_start, length)[0]
+        return spans, last_start
+
+    def wrap_spans(self, text, width):
+        return [x[:2] for x in self._wrap_spans(text, width)[0]]
+
+    def wrap(self, text, width):
+        text = WHITESPACE_RE.sub(' ', text.expandtabs())
+        return [text[start:end] for start, end, chunk in
+                self._wrap_spans(text, width)[0]]
+
+    def fill(self, text, width):
+        return '\n'.join(self.wrap(text, width))
+
+    @staticmethod
+    def normalize(text, column=0):
+        # whitespace of wrap() for text starting at column, and the column
+        # at its end; expandtabs() starts a new column after \n and \r
+        pad = column % 8
+        text = ('x' * pad + text).expandtabs()[pad:]
+        last = max(text.rfind('\n'), text.rfind('\r'))
+        if last >= 0:
+            column = len(text) - last - 1
+        else:
+            column += len(text)
+        return WHITESPACE_RE.sub(' ', text), column % 8
+
+    def wrap_iter(self, pieces, width, buffer_size=4096):
+        # same as wrap(''.join(pieces), width), only keeping the buffer and
+        # the last unfinished line in memory
+        buf = ''
+        skip = 0
+        column = 0
+        has_lines = False
+        parts = []
+        size = 0
+        for piece in pieces:
+            parts.append(piece)
+            size += len(piece)
+            if size < buffer_size:
+                continue
+            text, column = self.normalize(''.join(parts), column)
+            buf += text
+            parts = []
+            size = 0
+            spans, last_start = self._wrap_spans(buf, width, has_lines, skip)
+            if last_start and buf[last_start] in '.e':
+                # a number cut at the end of the buffer may go on with the
+                # following text, and take in the last chunk
+                last_start = self.chunks_re.match(buf, 0, last_start).start(1)
+            # the last chunk may still grow with the following text, which
+            # can change its lines and the line before it
+            keep = len(spans)
+            while keep and spans[keep-1][1] > last_start:
+                keep -= 1
+            keep -= 1
+            if keep <= 0:
+                continue
+            for start, end, chunk in spans[:keep]:
+                yield buf[start:end]
+            has_lines = True
+            # rescan from the chunk start to get the same chunks
+            start, end, chunk = spans[keep]
+            buf = buf[chunk:]
+            skip = start - chunk
+        buf += self.normalize(''.join(parts), column)[0]
+        for start, end, chunk in self._wrap_spans(
+                buf, width, has_lines, skip)[0]:
+            yield buf[start:end]
+
+
+def check_wrap_iter(wrapper, count, seed=0):
+    # wrap_iter() of random text split into random pieces must give the
+    # lines of wrap(). Returns the failed cases.
+    import random
+    tokens = (
+        '中', '文字', '（', '）', '，', '。', 'a', 'word', 'x' * 15, ' ', '  ',
+        '\t', '\n', '\r', 'a\tb', '1', '23', '4.5', '6e+7', '.', 'e', '-',
+        '--', '$', '¥', '12345678901', 'abcdefghijklmnopq')
+    failed = []
+    for i in range(count):
+        rnd = random.Random('%s-%d' % (seed, i))
+        text = ''.join(rnd.choices(tokens, k=rnd.randint(1, 300)))
+        width = rnd.randint(1, 20)
+        buffer_size = rnd.randint(1, 40)
+        cuts = sorted(rnd.sample(range(1, len(text) + 1),
+                                 rnd.randint(0, len(text) // 4)))
+        pieces = [text[start:end] for start, end in
+                  zip([0] + cuts, cuts + [len(text)])]
+        if (list(wrapper.wrap_iter(pieces, width, buffer_size)) !=
+                wrapper.wrap(text, width)):
+            failed.append((text, width, buffer_size, pieces))
+    return failed
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Check that wrap_iter() gives the lines of wrap() on '
+        'random text.')
+    parser.add_argument('-n', '--count', type=int, default=10000,
+        help='Number of random cases')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    args = parser.parse_args()
+    failed = check_wrap_iter(
+        CJKWrapper('（“', '）”，。'), args.count, args.seed)
+    for text, width, buffer_size, pieces in failed[:10]:
+        print('width %d, buffer %d: %r' % (width, buffer_size, pieces))
+    print('%d/%d cases differ' % (len(failed), args.count))
+    raise SystemExit(1 if failed else 0)
@@ -1,18 +1,48 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import io
 import os
 import re
-import sys
+import time
+import zlib
+import json
 import base64
 import shutil
+import socket
 import random
+import struct
+import tarfile
+import asyncio
+import sqlite3
 import hashlib
+import argparse
+import functools
 import tempfile
 import itertools
+import threading
+import multiprocessing
 import subprocess
 import contextlib
-import multiprocessing.dummy
+import collections
+import unicodedata
+import concurrent.futures
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+try:
+    import fontTools.ttLib
+    import fontTools.subset
+except ImportError:
+    fontTools = None
+
+try:
+    import line_renderer
+except ImportError:
+    line_renderer = None
 
 random.seed(12345)
 
@@ -24,7 +54,20 @@ CHARMAP_V = str.maketrans(
 ROOT_DIR = os.path.abspath(os.path.dirname(__file__))
 LANGDATA_DIR = os.path.join(ROOT_DIR, 'langdata')
 FONTS_DIR = os.path.join(ROOT_DIR, 'fonts')
+# the fonts directory of text2image, the subsets of --subset-fonts
+RENDER_FONTS_DIR = FONTS_DIR
 TMP_DIR = '/dev/shm'
+MANIFEST_FILE = 'render_manifest.db'
+METRICS_FILE = 'render_metrics.jsonl'
+# seconds before a hung training tool is killed
+PROCESS_TIMEOUT = 600
+LSTMF_SHARD_DIR = 'lstmf_shards'
+FC_CACHE_DIR = 'fontconfig_cache'
+FONT_SUBSET_DIR = 'font_subsets'
+LSTMF_SHARD_SIZE = 1 << 30
+# a claimed task of a dead worker goes back to the queue after this long
+QUEUE_LEASE = 300
+QUEUE_ATTEMPTS = 3
 
 TRAINING_BIN = os.path.dirname(shutil.which('tesseract'))
 TESSDATA_PREFIX = os.environ.get(
@@ -34,16 +77,10 @@ re_bold = re.compile(r'Bold|Heavy|W5|W7|W9|W12|Cu|Da|weight')
 re_serif = re.compile(r'Song|Ming|Sun|Serif|HanaMin', re.I)
 re_light = re.compile(r'Light|BaoSong', re.I)
 
+RENDER_EXTS = ('.txt', '.tif', '.box', '.lstmf')
 
-def grouper_it(n, iterable):
-    it = iter(iterable)
-    while True:
-        chunk_it = itertools.islice(it, n)
-        try:
-            first_el = next(chunk_it)
-        except StopIteration:
-            return
-        yield itertools.chain((first_el,), chunk_it)
+RenderParams = collections.namedtuple(
+    'RenderParams', 'writing_mode psm xsize ysize dpi exposure')
 
 
 def check_mtime(src, dst):
@@ -80,24 +117,70 @@ def line_hash_num(s, font):
     return num / total
 
 
-def generate_line_img(path, font, line, tmpdir, vertical=False):
-    line_hash = base64.b32encode(hashlib.blake2b(
+def line_hash_nums(lines, font):
+    # line_hash_num() of the lines with one font, hashing the font once
+    size = 6
+    total = 1<<(size*8)
+    prefix = hashlib.blake2b(
+        (font + '\n').encode('utf-8'), digest_size=size)
+    for line in lines:
+        h = prefix.copy()
+        h.update(line.encode('utf-8'))
+        yield int.from_bytes(h.digest(), 'big') / total
+
+
+def sample_pairs(lines, fonts, by_font=False):
+    # The sampled (line, font) pairs, line by line, or font by font to fill
+    # the batches of a font.
+    lines = list(lines)
+    masks = []
+    for font, ratio in fonts:
+        if ratio >= 1:
+            masks.append([True] * len(lines))
+        elif ratio <= 0:
+            masks.append([False] * len(lines))
+        else:
+            masks.append([num < ratio for num in line_hash_nums(lines, font)])
+    if by_font:
+        return [(line, font) for (font, ratio), mask in zip(fonts, masks)
+                for line, sampled in zip(lines, mask) if sampled]
+    return [(line, font) for i, line in enumerate(lines)
+            for (font, ratio), mask in zip(fonts, masks) if mask[i]]
+
+
+def line_hash(line):
+    return base64.b32encode(hashlib.blake2b(
         line.encode('utf-8'), digest_size=20).digest()).decode('ascii')
-    font_dir = os.path.join(path, font_to_filename(font))
-    if not os.path.isdir(font_dir):
-        os.makedirs(font_dir, exist_ok=True)
-    filename_base = os.path.join(font_dir, line_hash)
-    if all(os.path.isfile(filename_base + ext) and
-           os.stat(filename_base + ext).st_size > 0
-           for ext in ('.txt', '.tif', '.box', '.lstmf')):
-        # print(' [skip] %s %s: %s' % (line_hash, font, line[:20]))
-        return filename_base
-    # print(' [gen] %s %s: %s' % (line_hash, font, line[:20]))
-    for ext in ('.txt', '.tif', '.box', '.lstmf'):
-        with contextlib.suppress(FileNotFoundError):
-            os.remove(filename_base + ext)
-    with open(filename_base + '.txt', 'w', encoding='utf-8') as f:
-        f.write(line)
+
+
+def line_shard(name):
+    # two levels of 32 directories for each font, by the first characters of
+    # the base32 hash
+    return os.path.join(name[0], name[1])
+
+
+def line_filename_base(path, font, line):
+    name = line_hash(line)
+    return os.path.join(path, font_to_filename(font), line_shard(name), name)
+
+
+def scan_render_files(font_dir):
+    # {line hash: {ext: size}} of the files in the shard directories
+    file_sizes = collections.defaultdict(dict)
+    for root, dirs, files in os.walk(font_dir):
+        for filename in files:
+            name, ext = os.path.splitext(filename)
+            if (ext in RENDER_EXTS and
+                root == os.path.join(font_dir, line_shard(name))):
+                file_sizes[name][ext] = os.stat(
+                    os.path.join(root, filename)).st_size
+    return file_sizes
+
+
+def render_params(font, line, vertical=False):
+    # fixed for each (line, font), so lines with the same parameters can be
+    # rendered in one batch
+    rnd = random.Random('%s\n%s' % (font, line))
     if vertical:
         writing_mode = 'vertical'
         psm = '5'  # Assume a single uniform block of vertically aligned text.
@@ -114,96 +197,1982 @@ def generate_line_img(path, font, line, tmpdir, vertical=False):
     elif re_serif.search(font):
         # make serif bolder
         exposure_level = 1
-    if random.random() < 0.3:
+    if rnd.random() < 0.3:
         if vertical:
-            dpi = random.choice((250, 350))
+            dpi = rnd.choice((250, 350))
         else:
-            dpi = random.choice((200, 250)) 
+            dpi = rnd.choice((200, 250))
     else:
         dpi = 300
         if exposure_level == 0:
             exposure_level = -1
-    exposure = random.choice((exposure_level, 0, 0))
-    for i in range(3):
-        for ext in ('.tif', '.box', '.lstmf'):
-            with contextlib.suppress(FileNotFoundError):
-                os.remove(filename_base + ext)
+    exposure = rnd.choice((exposure_level, 0, 0))
+    return RenderParams(writing_mode, psm, xsize, ysize, dpi, exposure)
+
+
+def params_key(params):
+    return ','.join(map(str, params))
+
+
+@functools.lru_cache()
+def tool_version():
+    proc = subprocess.run(
+        (os.path.join(TRAINING_BIN, 'tesseract'), '--version'),
+        capture_output=True)
+    output = (proc.stdout or proc.stderr).decode('utf-8', errors='replace')
+    return output.strip().split('\n')[0]
+
+
+class RenderManifest:
+    # Completed renders, so that a rerun is planned with one query instead
+    # of checking the files of every (line, font) pair.
+    def __init__(self, filename=MANIFEST_FILE):
+        self.db = sqlite3.connect(filename)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS renders (
+                filename_base TEXT PRIMARY KEY,
+                path TEXT NOT NULL,
+                line_hash TEXT NOT NULL,
+                font TEXT NOT NULL,
+                params TEXT NOT NULL,
+                tool_version TEXT NOT NULL,
+                txt_size INTEGER NOT NULL,
+                tif_size INTEGER NOT NULL,
+                box_size INTEGER NOT NULL,
+                lstmf_size INTEGER NOT NULL,
+                created REAL NOT NULL
+            )""")
+        self.db.execute(
+            'CREATE INDEX IF NOT EXISTS idx_renders_path ON renders (path)')
+        # .lstmf files stored in the shard archives
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS packed (
+                filename_base TEXT PRIMARY KEY,
+                shard TEXT NOT NULL,
+                offset INTEGER NOT NULL,
+                size INTEGER NOT NULL
+            )""")
+        # the lines and fonts of each source at the last run, to plan the
+        # next one from the changes
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS dataset_lines (
+                source TEXT NOT NULL,
+                path TEXT NOT NULL,
+                line_hash TEXT NOT NULL,
+                line TEXT NOT NULL,
+                PRIMARY KEY (source, path, line_hash)
+            )""")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS dataset_fonts (
+                source TEXT NOT NULL,
+                path TEXT NOT NULL,
+                font TEXT NOT NULL,
+                ratio REAL NOT NULL,
+                PRIMARY KEY (source, path, font)
+            )""")
+        # the pairs planned by --plan for the next run of the same inputs
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS plans (
+                source TEXT NOT NULL,
+                path TEXT NOT NULL,
+                digest TEXT NOT NULL,
+                created REAL NOT NULL,
+                PRIMARY KEY (source, path)
+            )""")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS plan_pairs (
+                source TEXT NOT NULL,
+                path TEXT NOT NULL,
+                remove INTEGER NOT NULL,
+                line TEXT NOT NULL,
+                font TEXT NOT NULL
+            )""")
+        self.db.execute(
+            'CREATE INDEX IF NOT EXISTS idx_plan_pairs_path '
+            'ON plan_pairs (source, path)')
+        self.tool_version = tool_version()
+
+    def completed(self, path):
+        # {filename_base: (params, tool_version)}
+        return {row[0]: row[1:] for row in self.db.execute(
+            'SELECT filename_base, params, tool_version FROM renders '
+            'WHERE path = ?', (path,))}
+
+    def render_state(self, filename_base):
+        # (params, tool_version) or None, like completed()
+        return self.db.execute(
+            'SELECT params, tool_version FROM renders '
+            'WHERE filename_base = ?', (filename_base,)).fetchone()
+
+    def add(self, path, filename_base, font, params, sizes=None):
+        if sizes is None:
+            sizes = [os.stat(filename_base + ext).st_size
+                     for ext in RENDER_EXTS]
+        self.db.execute(
+            'REPLACE INTO renders VALUES (?,?,?,?,?,?,?,?,?,?,?)',
+            [filename_base, path, os.path.basename(filename_base), font,
+             params_key(params), self.tool_version] + list(sizes) +
+            [time.time()])
+        # a packed copy is of an older render
+        self.db.execute(
+            'DELETE FROM packed WHERE filename_base = ?', (filename_base,))
+
+    def move(self, filename_base, new_filename_base):
+        for table in ('renders', 'packed'):
+            self.db.execute(
+                'UPDATE %s SET filename_base = ? WHERE filename_base = ?'
+                % table, (new_filename_base, filename_base))
+
+    def remove(self, filename_base):
+        for table in ('renders', 'packed'):
+            self.db.execute(
+                'DELETE FROM %s WHERE filename_base = ?' % table,
+                (filename_base,))
+
+    def has_dataset(self, source):
+        return self.db.execute(
+            'SELECT 1 FROM dataset_fonts WHERE source = ? LIMIT 1',
+            (source,)).fetchone() is not None
+
+    def dataset(self, source, path):
+        # lines and {font: ratio} of the last run
+        lines = [row[0] for row in self.db.execute(
+            'SELECT line FROM dataset_lines WHERE source = ? AND path = ?',
+            (source, path))]
+        fonts = dict(self.db.execute(
+            'SELECT font, ratio FROM dataset_fonts '
+            'WHERE source = ? AND path = ?', (source, path)))
+        return lines, fonts
+
+    def save_dataset(self, source, path, lines, fonts):
+        self.db.execute(
+            'DELETE FROM dataset_lines WHERE source = ? AND path = ?',
+            (source, path))
+        self.db.executemany(
+            'INSERT INTO dataset_lines VALUES (?,?,?,?)',
+            ((source, path, line_hash(line), line)
+             for line in dict.fromkeys(lines)))
+        self.db.execute(
+            'DELETE FROM dataset_fonts WHERE source = ? AND path = ?',
+            (source, path))
+        self.db.executemany(
+            'INSERT INTO dataset_fonts VALUES (?,?,?,?)',
+            ((source, path, font, ratio)
+             for font, ratio in dict(fonts).items()))
+        self.commit()
+
+    def is_wanted(self, source, path, font, line):
+        # whether another source sharing the path samples the pair
+        for ratio, in self.db.execute(
+            'SELECT dataset_fonts.ratio FROM dataset_lines '
+            'JOIN dataset_fonts USING (source, path) '
+            'WHERE source != ? AND path = ? AND line_hash = ? AND font = ?',
+            (source, path, line_hash(line), font)):
+            if line_hash_num(line, font) < ratio:
+                return True
+        return False
+
+    def save_plan(self, source, path, digest, render, remove):
+        self.drop_plan(source, path)
+        self.db.execute('INSERT INTO plans VALUES (?,?,?,?)',
+                        (source, path, digest, time.time()))
+        self.db.executemany(
+            'INSERT INTO plan_pairs VALUES (?,?,?,?,?)', itertools.chain(
+                ((source, path, 0, line, font) for line, font in render),
+                ((source, path, 1, line, font) for line, font in remove)))
+        self.commit()
+
+    def saved_plan(self, source, path, digest):
+        # the pairs to render and to remove of a plan of the same inputs,
+        # or None
+        row = self.db.execute(
+            'SELECT digest FROM plans WHERE source = ? AND path = ?',
+            (source, path)).fetchone()
+        if row is None or row[0] != digest:
+            return None
+        pairs = ([], [])
+        for remove, line, font in self.db.execute(
+            'SELECT remove, line, font FROM plan_pairs '
+            'WHERE source = ? AND path = ? ORDER BY rowid', (source, path)):
+            pairs[remove].append((line, font))
+        return pairs
+
+    def drop_plan(self, source, path):
+        for table in ('plans', 'plan_pairs'):
+            self.db.execute(
+                'DELETE FROM %s WHERE source = ? AND path = ?' % table,
+                (source, path))
+
+    def to_pack(self, path):
+        # {filename_base: lstmf size} of the renders not in a shard
+        return dict(self.db.execute(
+            'SELECT renders.filename_base, renders.lstmf_size FROM renders '
+            'LEFT JOIN packed USING (filename_base) '
+            'WHERE renders.path = ? AND packed.shard IS NULL', (path,)))
+
+    def add_packed(self, filename_base, shard, offset, size):
+        self.db.execute('REPLACE INTO packed VALUES (?,?,?,?)',
+                        (filename_base, shard, offset, size))
+
+    def packed_location(self, filename_base):
+        # (shard, offset, size) or None
+        return self.db.execute(
+            'SELECT shard, offset, size FROM packed WHERE filename_base = ?',
+            (filename_base,)).fetchone()
+
+    def rebuild(self, path, fonts, lines, vertical):
+        # record the complete files on disk of the current lines
+        print('Rebuilding the manifest of %s...' % path)
+        lines_by_hash = {line_hash(line): line for line in lines}
+        count = 0
+        for font, ratio in fonts:
+            font_dir = os.path.join(path, font_to_filename(font))
+            file_sizes = scan_render_files(font_dir)
+            found = set()
+            for name, sizes in file_sizes.items():
+                sizes = [sizes.get(ext) for ext in RENDER_EXTS]
+                if name not in lines_by_hash or not all(sizes):
+                    continue
+                line = lines_by_hash[name]
+                self.add(path, line_filename_base(path, font, line), font,
+                         render_params(font, line, vertical), sizes)
+                found.add(name)
+            # other languages of chi_all may share the directory
+            for filename_base, name in self.db.execute(
+                'SELECT filename_base, line_hash FROM renders '
+                'WHERE path = ? AND font = ?', (path, font)
+            ).fetchall():
+                if (name in lines_by_hash and name not in found and
+                    not self.packed_location(filename_base)):
+                    self.remove(filename_base)
+            count += len(found)
+        self.commit()
+        print('Found %d rendered images.' % count)
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+def normalize_font_name(name):
+    return ' '.join(name.replace(',', ' ').lower().split())
+
+
+def file_hash(filename):
+    h = hashlib.blake2b(digest_size=20)
+    with open(filename, 'rb') as f:
+        for block in iter(functools.partial(f.read, 1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def font_face_names(ttf):
+    # the names of a face as "family style", and its family names
+    def get(name_id):
+        return ttf['name'].getDebugName(name_id)
+
+    names = set()
+    families = set()
+    full_name = get(4)
+    if full_name:
+        names.add(full_name)
+    for family, style in ((get(1), get(2)), (get(16), get(17))):
+        if not family:
+            continue
+        families.add(family)
+        if style and style.lower() not in ('regular', 'normal', 'book'):
+            names.add('%s %s' % (family, style))
+        else:
+            names.add(family)
+    return ([normalize_font_name(x) for x in names],
+            [normalize_font_name(x) for x in families])
+
+
+class FontCoverage:
+    # Characters in the cmap of each font in the fonts directory, cached in
+    # the manifest by the hash of the font file.
+    FONT_EXTS = ('.ttf', '.otf', '.ttc', '.otc')
+
+    def __init__(self, db, fonts_dir=FONTS_DIR):
+        self.db = db
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS font_files (
+                filename TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime REAL NOT NULL,
+                hash TEXT NOT NULL
+            )""")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS font_coverage (
+                hash TEXT NOT NULL,
+                font_number INTEGER NOT NULL,
+                names TEXT NOT NULL,
+                families TEXT NOT NULL,
+                chars BLOB NOT NULL,
+                PRIMARY KEY (hash, font_number)
+            )""")
+        # {normalized name: frozenset of characters}
+        self.by_name = {}
+        self.by_family = {}
+        # {normalized name: (font file, face index)}
+        self.faces_by_name = {}
+        self.faces_by_family = {}
+        # {font file: hash}
+        self.hashes = {}
+        self.cache = {}
+        self.scan(fonts_dir)
+
+    def read_faces(self, filename):
+        if filename.lower().endswith(('.ttc', '.otc')):
+            ttc = fontTools.ttLib.TTCollection(filename, lazy=True)
+            try:
+                return [self.read_face(ttf) for ttf in ttc.fonts]
+            finally:
+                ttc.close()
+        with fontTools.ttLib.TTFont(filename, lazy=True) as ttf:
+            return [self.read_face(ttf)]
+
+    @staticmethod
+    def read_face(ttf):
+        names, families = font_face_names(ttf)
+        cmap = ttf.getBestCmap() or {}
+        chars = ''.join(chr(x) for x in sorted(cmap)
+                        if not 0xD800 <= x < 0xE000)
+        return ('\n'.join(names), '\n'.join(families),
+                zlib.compress(chars.encode('utf-8')))
+
+    def scan(self, fonts_dir):
+        for root, dirs, files in os.walk(fonts_dir):
+            for filename in sorted(files):
+                if not filename.lower().endswith(self.FONT_EXTS):
+                    continue
+                filename = os.path.join(root, filename)
+                try:
+                    self.load_font(filename)
+                except Exception as ex:
+                    print('Font coverage of %s: %s' % (filename, ex))
+        self.db.commit()
+
+    def load_font(self, filename):
+        st = os.stat(filename)
+        row = self.db.execute(
+            'SELECT hash FROM font_files '
+            'WHERE filename = ? AND size = ? AND mtime = ?',
+            (filename, st.st_size, st.st_mtime)).fetchone()
+        if row:
+            font_hash = row[0]
+        else:
+            font_hash = file_hash(filename)
+            self.db.execute('REPLACE INTO font_files VALUES (?,?,?,?)',
+                            (filename, st.st_size, st.st_mtime, font_hash))
+        self.hashes[filename] = font_hash
+        faces = self.db.execute(
+            'SELECT names, families, chars FROM font_coverage '
+            'WHERE hash = ? ORDER BY font_number', (font_hash,)).fetchall()
+        if not faces:
+            faces = self.read_faces(filename)
+            self.db.executemany(
+                'INSERT INTO font_coverage VALUES (?,?,?,?,?)',
+                ((font_hash, i) + face for i, face in enumerate(faces)))
+        for i, (names, families, chars) in enumerate(faces):
+            # spaces are rendered without glyphs
+            charset = frozenset(zlib.decompress(chars).decode('utf-8') + ' ')
+            for name in names.split('\n'):
+                self.by_name.setdefault(name, charset)
+                self.faces_by_name.setdefault(name, (filename, i))
+            for name in families.split('\n'):
+                self.by_family.setdefault(name, charset)
+                self.faces_by_family.setdefault(name, (filename, i))
+
+    def charset(self, font):
+        # None if the font is not found
         try:
-            subprocess.run((
-                os.path.join(TRAINING_BIN, 'text2image'),
-                '--text=%s.txt' % filename_base,
-                '--outputbase=%s' % filename_base,
-                '--font=%s' % font,
-                '--fonts_dir=%s' % FONTS_DIR,
-                '--fontconfig_tmpdir=%s' % tmpdir,
-                '--writing_mode=' + writing_mode,
-                '--exposure=%s' % exposure, '--resolution=%d' % dpi,
-                '--margin=30', '--xsize=%d' % xsize, '--ysize=%d' % ysize,
-                '--rotate_image=false', '--strip_unrenderable_words=false'
-            ), capture_output=True, check=True)
-            if not os.path.isfile(filename_base + '.tif'):
-                continue
-            subprocess.run((
-                os.path.join(TRAINING_BIN, 'tesseract'),
-                '%s.tif' % filename_base, filename_base,
-                '--psm', psm, 'lstm.train'
-            ), capture_output=True, check=True)
-        except subprocess.CalledProcessError as ex:
-            print('Command returned %s: %s' % (ex.returncode, ' '.join(ex.cmd)))
-            print(ex.stdout.decode('utf-8', errors='replace'))
-            print(ex.stderr.decode('utf-8', errors='replace'))
+            return self.cache[font]
+        except KeyError:
+            pass
+        name = normalize_font_name(font)
+        charset = self.by_name.get(name, self.by_family.get(name))
+        if charset is None:
+            print('Font coverage: %s not found in the fonts directory.' % font)
+        self.cache[font] = charset
+        return charset
+
+    def face(self, font):
+        # (font file, face index) or None
+        name = normalize_font_name(font)
+        return self.faces_by_name.get(name, self.faces_by_family.get(name))
+
+    def covers(self, font, line):
+        charset = self.charset(font)
+        return charset is None or charset.issuperset(line)
+
+
+class PILRenderer:
+    # Renders lines with line_renderer in a process pool instead of
+    # text2image, for the fonts found in the fonts directory.
+    def __init__(self, coverage, jobs=None):
+        self.coverage = coverage
+        # forking a process with running threads is unsafe
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            jobs, mp_context=multiprocessing.get_context('spawn'))
+        self.glyph_maps = {}
+
+    def glyph_map(self, font):
+        # the vertical forms the font has
+        if font not in self.glyph_maps:
+            charset = self.coverage.charset(font) or ()
+            self.glyph_maps[font] = {
+                chr(src): chr(dst) for src, dst in CHARMAP_V.items()
+                if chr(dst) in charset}
+        return self.glyph_maps[font]
+
+    def submit(self, filename_base, font, line, params):
+        # a Future of whether the line is rendered, None for unknown fonts
+        face = self.coverage.face(font)
+        if face is None:
+            return None
+        vertical = params.writing_mode == 'vertical'
         try:
-            generate_txt_from_box(filename_base)
-            if all(os.path.isfile(filename_base + ext) and
-                   os.stat(filename_base + ext).st_size > 0
-                   for ext in ('.txt', '.tif', '.box', '.lstmf')):
-                break
-        except (FileNotFoundError, UnicodeError):
-            print('Box decode error: %s.box' % filename_base)
+            return self.executor.submit(
+                line_renderer.render_line, filename_base, line, face[0],
+                face[1], vertical, params.dpi, params.exposure, params.xsize,
+                params.ysize, 30, self.glyph_map(font) if vertical else None)
+        except concurrent.futures.BrokenExecutor as ex:
+            # a worker died, the lines go to text2image
+            print('PIL renderer error: %s' % ex)
+            return None
+
+    def close(self):
+        self.executor.shutdown()
+
+
+def is_rendered(filename_base):
+    return all(os.path.isfile(filename_base + ext) and
+               os.stat(filename_base + ext).st_size > 0
+               for ext in RENDER_EXTS)
+
+
+def remove_outputs(filename_base, exts=RENDER_EXTS):
+    for ext in exts:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(filename_base + ext)
+
+
+class StepResult:
+    # The result of a render step, false if it failed. seconds: run time of
+    # the tool, error: 'error' or 'timeout' if it failed.
+    __slots__ = ('ok', 'seconds', 'error')
+
+    def __init__(self, ok, seconds, error=None):
+        self.ok = ok
+        self.seconds = seconds
+        self.error = error
+
+    def __bool__(self):
+        return self.ok
+
+
+def print_failed_cmd(cmd, returncode, stdout, stderr):
+    print('Command returned %s: %s' % (returncode, ' '.join(cmd)))
+    print(stdout.decode('utf-8', errors='replace'))
+    print(stderr.decode('utf-8', errors='replace'))
+
+
+def run_training_bin(name, *args):
+    cmd = (os.path.join(TRAINING_BIN, name),) + args
+    start = time.monotonic()
+    try:
+        subprocess.run(cmd, capture_output=True, check=True,
+                       timeout=PROCESS_TIMEOUT)
+    except subprocess.CalledProcessError as ex:
+        print_failed_cmd(ex.cmd, ex.returncode, ex.stdout, ex.stderr)
+        return StepResult(False, time.monotonic() - start, 'error')
+    except subprocess.TimeoutExpired:
+        print('Command timed out after %ss: %s' % (
+            PROCESS_TIMEOUT, ' '.join(cmd)))
+        return StepResult(False, time.monotonic() - start, 'timeout')
+    return StepResult(True, time.monotonic() - start)
+
+
+async def run_training_bin_async(name, *args):
+    cmd = (os.path.join(TRAINING_BIN, name),) + args
+    start = time.monotonic()
+    proc = await asyncio.create_subprocess_exec(
+        *cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        stdout, stderr = await asyncio.wait_for(
+            proc.communicate(), PROCESS_TIMEOUT)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        print('Command timed out after %ss: %s' % (
+            PROCESS_TIMEOUT, ' '.join(cmd)))
+        return StepResult(False, time.monotonic() - start, 'timeout')
+    if proc.returncode:
+        print_failed_cmd(cmd, proc.returncode, stdout, stderr)
+        return StepResult(False, time.monotonic() - start, 'error')
+    return StepResult(True, time.monotonic() - start)
+
+
+def available_memory():
+    # MemAvailable in bytes, None if unknown
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for ln in f:
+                if ln.startswith('MemAvailable:'):
+                    return int(ln.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+class ProcessLimiter:
+    # Async semaphore for the training tools, running fewer of them while
+    # the other processes keep the CPUs busy or memory is low.
+    def __init__(self, max_jobs, min_free_memory=1 << 30, interval=1):
+        self.max_jobs = max_jobs
+        self.min_free_memory = min_free_memory
+        self.interval = interval
+        self.running = 0
+        self.cond = asyncio.Condition()
+
+    def limit(self):
+        # our own processes are part of the load average
+        idle = os.cpu_count() - os.getloadavg()[0] + self.running
+        limit = min(self.max_jobs, max(1, int(idle)))
+        memory = available_memory()
+        if memory is not None and memory < self.min_free_memory:
+            limit = min(limit, max(1, self.running))
+        return limit
+
+    async def __aenter__(self):
+        async with self.cond:
+            while self.running >= self.limit():
+                # the load also changes without our processes exiting
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self.cond.wait(), self.interval)
+            self.running += 1
+
+    async def __aexit__(self, *exc_info):
+        async with self.cond:
+            self.running -= 1
+            self.cond.notify()
+
+
+def future_step(future, start):
+    # the StepResult of a finished in-process render, which fails on any
+    # exception of the renderer or its process pool
+    try:
+        ok = future.result()
+    except Exception as ex:
+        print('Render error: %r' % ex)
+        ok = False
+    return StepResult(ok, time.monotonic() - start, None if ok else 'error')
+
+
+def run_steps(steps):
+    # Run the commands yielded by a render generator and send back their
+    # StepResult, returns the result of the generator. The in-process
+    # renders are yielded as futures.
+    try:
+        cmd = next(steps)
+        while True:
+            if isinstance(cmd, concurrent.futures.Future):
+                start = time.monotonic()
+                concurrent.futures.wait((cmd,))
+                result = future_step(cmd, start)
+            else:
+                result = run_training_bin(*cmd)
+            cmd = steps.send(result)
+    except StopIteration as ex:
+        return ex.value
+
+
+def send_step(steps, result=None):
+    # (finished, the next command or the result of the generator), as a
+    # StopIteration can't be raised through a future
+    try:
+        return False, steps.send(result)
+    except StopIteration as ex:
+        return True, ex.value
+
+
+async def run_steps_async(steps, limiter):
+    # Like run_steps, but the generator reads and moves the files between
+    # the commands in the default executor instead of the event loop.
+    loop = asyncio.get_running_loop()
+    finished, cmd = await loop.run_in_executor(None, send_step, steps)
+    while not finished:
+        if isinstance(cmd, concurrent.futures.Future):
+            start = time.monotonic()
+            with contextlib.suppress(Exception):
+                await asyncio.wrap_future(cmd)
+            result = future_step(cmd, start)
+        else:
+            async with limiter:
+                result = await run_training_bin_async(*cmd)
+        finished, cmd = await loop.run_in_executor(
+            None, send_step, steps, result)
+    return cmd
+
+
+def font_set_hash(fonts_dir=FONTS_DIR):
+    # changes with the fonts, from the file names, sizes and mtimes
+    h = hashlib.blake2b(digest_size=10)
+    h.update(os.path.abspath(fonts_dir).encode('utf-8'))
+    for root, dirs, files in os.walk(fonts_dir):
+        dirs.sort()
+        for filename in sorted(files):
+            filename = os.path.join(root, filename)
+            st = os.stat(filename)
+            h.update(('\n%s\n%d\n%d' % (
+                os.path.relpath(filename, fonts_dir), st.st_size,
+                st.st_mtime_ns)).encode('utf-8'))
+    return h.hexdigest()
+
+
+def fontconfig_cache(cache_root=FC_CACHE_DIR):
+    # A fontconfig cache of the fonts directory, built once for each set of
+    # fonts and kept for the next runs. None if it can't be built. Not
+    # memoized, as the cache is relative to the working directory.
+    cache_dir = os.path.join(cache_root, font_set_hash(RENDER_FONTS_DIR))
+    if os.path.isfile(os.path.join(cache_dir, '.complete')):
+        return cache_dir
+    # the caches of other font sets
+    shutil.rmtree(cache_root, ignore_errors=True)
+    os.makedirs(cache_dir)
+    print('Building the fontconfig cache...')
+    if not run_training_bin(
+        'text2image', '--fonts_dir=%s' % RENDER_FONTS_DIR,
+        '--fontconfig_tmpdir=%s' % os.path.abspath(cache_dir),
+        '--list_available_fonts'
+    ):
+        return None
+    open(os.path.join(cache_dir, '.complete'), 'w').close()
+    return cache_dir
+
+
+def copy_fontconfig_cache(cache_dir, tmpdir):
+    # fontconfig replaces the cache files instead of writing to them, so
+    # they can be linked
+    with os.scandir(cache_dir) as it:
+        for entry in it:
+            if entry.name in ('.complete', 'fonts.conf') or not entry.is_file():
+                continue
+            link_or_copy(entry.path, os.path.join(tmpdir, entry.name))
+
+
+def training_charset(texts, punc_file):
+    # the characters text2image can be asked to render: the lines, the
+    # punctuations, ASCII and the vertical forms
+    chars = set(''.join(itertools.chain.from_iterable(texts)))
+    with open(punc_file, 'r', encoding='utf-8') as f:
+        chars.update(f.read())
+    chars.update(map(chr, range(0x20, 0x7F)))
+    chars.update(map(chr, CHARMAP_V))
+    chars.update(map(chr, CHARMAP_V.values()))
+    return ''.join(sorted(
+        x for x in chars if not unicodedata.category(x).startswith('C')))
+
+
+def subset_font(filename, chars, output):
+    # Keeps the names, the layout features (vertical forms), the hinting
+    # and the bitmaps, so text2image finds the font by the same name and
+    # renders the same glyphs. Run in worker processes.
+    options = fontTools.subset.Options()
+    options.layout_features = ['*']
+    options.layout_scripts = ['*']
+    options.name_IDs = ['*']
+    options.name_languages = ['*']
+    options.name_legacy = True
+    options.legacy_cmap = True
+    options.symbol_cmap = True
+    options.legacy_kern = True
+    options.notdef_outline = True
+    options.prune_unicode_ranges = False
+    options.prune_codepage_ranges = False
+    options.drop_tables = [x for x in options.drop_tables
+                           if x not in ('EBDT', 'EBLC', 'EBSC')]
+    collection = filename.lower().endswith(('.ttc', '.otc'))
+    if collection:
+        with fontTools.ttLib.TTCollection(filename, lazy=True) as ttc:
+            count = len(ttc.fonts)
+        fonts = [fontTools.ttLib.TTFont(filename, fontNumber=i)
+                 for i in range(count)]
     else:
+        fonts = [fontTools.ttLib.TTFont(filename)]
+    for font in fonts:
+        subsetter = fontTools.subset.Subsetter(options)
+        subsetter.populate(text=chars)
+        subsetter.subset(font)
+    if collection:
+        ttc = fontTools.ttLib.TTCollection()
+        ttc.fonts = fonts
+        ttc.save(output + '.tmp', shareTables=True)
+    else:
+        fonts[0].save(output + '.tmp')
+    for font in fonts:
+        font.close()
+    os.replace(output + '.tmp', output)
+
+
+def build_font_subsets(coverage, fonts, chars, jobs=None,
+                       cache_root=FONT_SUBSET_DIR, fonts_dir=FONTS_DIR):
+    # A fonts directory for text2image with subsets of the fonts of the
+    # list limited to chars, and symlinks to all the other files of the
+    # fonts directory. The subsets are named by the hash of the font, and
+    # kept for the next runs with the same chars. Returns the directory.
+    h = hashlib.blake2b(digest_size=10)
+    h.update(fontTools.version.encode('utf-8') + b'\0')
+    h.update(chars.encode('utf-8'))
+    subset_dir = os.path.join(cache_root, h.hexdigest())
+    # the subsets of other charsets
+    if os.path.isdir(cache_root):
+        for name in os.listdir(cache_root):
+            if name != h.hexdigest():
+                shutil.rmtree(os.path.join(cache_root, name),
+                              ignore_errors=True)
+    os.makedirs(subset_dir, exist_ok=True)
+
+    listed = set()
+    for font in fonts:
+        face = coverage.face(font)
+        if face is None:
+            print('Font subsets: %s not found in the fonts directory.' % font)
+        else:
+            listed.add(face[0])
+    # {path in subset_dir: font file to subset}
+    subsets = {}
+    # {path in subset_dir: file to link}, the same path as in fonts_dir
+    links = {}
+    for root, dirs, files in os.walk(fonts_dir):
+        for filename in files:
+            filename = os.path.join(root, filename)
+            if filename in listed and filename in coverage.hashes:
+                ext = os.path.splitext(filename)[1].lower()
+                subsets['%s-subset%s' % (
+                    coverage.hashes[filename], ext)] = filename
+            else:
+                links[os.path.relpath(filename, fonts_dir)] = filename
+    todo = {name: filename for name, filename in subsets.items()
+            if not os.path.isfile(os.path.join(subset_dir, name))}
+
+    if todo:
+        print('Building %d font subsets of %d characters...' % (
+            len(todo), len(chars)))
+        with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+            futures = {
+                executor.submit(subset_font, filename, chars,
+                                os.path.join(subset_dir, name)): name
+                for name, filename in todo.items()}
+            for future in concurrent.futures.as_completed(futures):
+                name = futures[future]
+                try:
+                    future.result()
+                except Exception as ex:
+                    # text2image gets the whole font, and the next run
+                    # tries again
+                    filename = subsets.pop(name)
+                    print('Font subset of %s: %s' % (filename, ex))
+                    # fontconfig would scan a partial file
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(os.path.join(subset_dir, name + '.tmp'))
+                    links[os.path.relpath(filename, fonts_dir)] = filename
+
+    # the files of removed fonts, and the links to other files
+    for root, dirs, files in os.walk(subset_dir, topdown=False):
+        for name in files + [x for x in dirs if os.path.islink(
+                os.path.join(root, x))]:
+            filename = os.path.join(root, name)
+            rel = os.path.relpath(filename, subset_dir)
+            if rel in subsets:
+                continue
+            if (rel in links and os.path.islink(filename) and
+                    os.readlink(filename) == os.path.abspath(links[rel])):
+                continue
+            os.remove(filename)
+        if root != subset_dir and not os.listdir(root):
+            os.rmdir(root)
+    for rel, filename in links.items():
+        output = os.path.join(subset_dir, rel)
+        if not os.path.lexists(output):
+            os.makedirs(os.path.dirname(output), exist_ok=True)
+            os.symlink(os.path.abspath(filename), output)
+    return subset_dir
+
+
+def text2image_cmd(text_file, outputbase, font, params, tmpdir):
+    return (
+        'text2image',
+        '--text=%s' % text_file,
+        '--outputbase=%s' % outputbase,
+        '--font=%s' % font,
+        '--fonts_dir=%s' % RENDER_FONTS_DIR,
+        '--fontconfig_tmpdir=%s' % tmpdir,
+        '--writing_mode=' + params.writing_mode,
+        '--exposure=%s' % params.exposure, '--resolution=%d' % params.dpi,
+        '--margin=30', '--xsize=%d' % params.xsize, '--ysize=%d' % params.ysize,
+        '--rotate_image=false', '--strip_unrenderable_words=false'
+    )
+
+
+def lstm_train_cmd(filename_base, params):
+    return (
+        'tesseract', '%s.tif' % filename_base, filename_base,
+        '--psm', params.psm, 'lstm.train')
+
+
+def finish_line_img(filename_base):
+    # None if the line is complete, else the failure class
+    try:
+        generate_txt_from_box(filename_base)
+    except (FileNotFoundError, UnicodeError):
+        print('Box decode error: %s.box' % filename_base)
+        return 'box_error'
+    if not is_rendered(filename_base):
+        return 'missing_output'
+    return None
+
+
+def new_sample(filename_base, font, line, params, batch=1):
+    # the metrics of rendering a line, see RenderMetrics
+    return {
+        'sample': filename_base,
+        'font': font,
+        'chars': len(line),
+        'writing_mode': params.writing_mode,
+        'dpi': params.dpi,
+        'exposure': params.exposure,
+        'renderer': None,
+        'batch': batch,
+        'attempts': 0,
+        'render_seconds': 0.0,
+        'train_seconds': 0.0,
+        'error': None,
+    }
+
+
+def share_step(samples, key, result):
+    # a step of several lines counts for each line in equal parts
+    for sample in samples:
+        sample[key] += result.seconds / len(samples)
+
+
+def generate_line_img_steps(path, font, line, tmpdir, vertical=False,
+                            renderer=None, metrics=None, sample=None):
+    # The render steps of a line, yields the training tool commands and gets
+    # back their StepResult. Returns the filename base or None.
+    # sample: the metrics of the line from a failed batch
+    filename_base = line_filename_base(path, font, line)
+    os.makedirs(os.path.dirname(filename_base), exist_ok=True)
+    if is_rendered(filename_base):
+        # print(' [skip] %s %s: %s' % (line_hash, font, line[:20]))
+        return filename_base
+    # print(' [gen] %s %s: %s' % (line_hash, font, line[:20]))
+    remove_outputs(filename_base)
+    with open(filename_base + '.txt', 'w', encoding='utf-8') as f:
+        f.write(line)
+    params = render_params(font, line, vertical)
+    if sample is None:
+        sample = new_sample(filename_base, font, line, params)
+    for i in range(3):
+        remove_outputs(filename_base, ('.tif', '.box', '.lstmf'))
+        sample['attempts'] += 1
+        # the retries use text2image
+        future = None
+        if renderer is not None and i == 0:
+            future = renderer.submit(filename_base, font, line, params)
+        if future is not None:
+            sample['renderer'] = 'pil'
+            result = yield future
+        else:
+            sample['renderer'] = 'text2image'
+            result = yield text2image_cmd(
+                filename_base + '.txt', filename_base, font, params, tmpdir)
+        sample['render_seconds'] += result.seconds
+        error = None
+        if not result:
+            error = 'render_' + result.error
+        elif not os.path.isfile(filename_base + '.tif'):
+            error = 'render_no_image'
+        else:
+            result = yield lstm_train_cmd(filename_base, params)
+            sample['train_seconds'] += result.seconds
+            if not result:
+                error = 'train_' + result.error
+        # the outputs decide, the tools may fail after writing them
+        sample['error'] = finish_line_img(filename_base)
+        if sample['error'] is None:
+            break
+        sample['error'] = error or sample['error']
+    if metrics is not None:
+        metrics.add(sample)
+    if sample['error'] is not None:
         return None
     return filename_base
 
 
-def generate_imgs(path, fonts, lines, vertical):
+def read_box_pages(filename):
+    # {page: [(char, left, bottom, right, top)]}
+    pages = collections.defaultdict(list)
+    with open(filename, 'r', encoding='utf-8') as f:
+        for ln in f:
+            ln = ln.rstrip('\n')
+            if not ln:
+                continue
+            ch, left, bottom, right, top, page = ln.rsplit(' ', 5)
+            pages[int(page)].append((ch, left, bottom, right, top))
+    return pages
+
+
+def split_batch_pages(batch_base, todo):
+    # Write the pages of a multi-page render as the files of the lines.
+    # A page is only used if it is exactly one of the lines, as long lines
+    # may wrap to the next page.
+    pending = collections.defaultdict(list)
+    for line, filename_base in todo:
+        pending[''.join(line.split())].append((line, filename_base))
+    pages = read_box_pages(batch_base + '.box')
+    with Image.open(batch_base + '.tif') as im:
+        save_args = {k: im.info[k] for k in ('compression', 'dpi')
+                     if k in im.info}
+        for page, boxes in sorted(pages.items()):
+            text = ''.join(box[0] or ' ' for box in boxes)
+            # a tab ends each text line
+            key = ''.join(text.split())
+            if '\t' in text.rstrip('\t') or not pending.get(key):
+                continue
+            line, filename_base = pending[key].pop(0)
+            remove_outputs(filename_base)
+            with open(filename_base + '.txt', 'w', encoding='utf-8') as f:
+                f.write(line)
+            with open(filename_base + '.box', 'w', encoding='utf-8') as f:
+                for box in boxes:
+                    f.write('%s %s %s %s %s 0\n' % box)
+            im.seek(page)
+            im.save(filename_base + '.tif', **save_args)
+            yield line, filename_base
+
+
+def skip_serialized(data, pos):
+    # a std::string or a std::vector<char>: uint32 size and the bytes
+    size, = struct.unpack_from('<I', data, pos)
+    return pos + 4 + size
+
+
+def read_lstmf_pages(filename):
+    # The pages of a DocumentData written by lstm.train, as {page number:
+    # (image name, the ImageData after the page number)}. None if the
+    # format is not the known one or a page number repeats.
+    with open(filename, 'rb') as f:
+        data = f.read()
+    pages = {}
+    try:
+        count, = struct.unpack_from('<I', data, 0)
+        pos = 4
+        for i in range(count):
+            pos += 1
+            if not data[pos-1]:
+                # null page
+                continue
+            name_end = skip_serialized(data, pos)
+            name = data[pos+4:name_end].decode('utf-8')
+            page_number, = struct.unpack_from('<i', data, name_end)
+            start = pos = name_end + 4
+            # image, language, transcription
+            for j in range(3):
+                pos = skip_serialized(data, pos)
+            # boxes of 4 int16
+            box_count, = struct.unpack_from('<I', data, pos)
+            pos += 4 + box_count * 8
+            text_count, = struct.unpack_from('<I', data, pos)
+            pos += 4
+            for j in range(text_count):
+                pos = skip_serialized(data, pos)
+            # vertical text flag
+            pos += 1
+            if page_number in pages:
+                return None
+            pages[page_number] = (name, data[start:pos])
+    except (struct.error, IndexError, UnicodeError):
+        return None
+    if pos != len(data):
+        return None
+    return pages
+
+
+def write_lstmf_page(filename, image_name, page):
+    # a DocumentData of one page, like lstm.train of a single image
+    name = image_name.encode('utf-8')
+    with open(filename, 'wb') as f:
+        f.write(struct.pack('<IBI', 1, 1, len(name)))
+        f.write(name)
+        f.write(struct.pack('<i', 0))
+        f.write(page)
+
+
+def lstm_train_batch_steps(todo, params, batch_dir, samples):
+    # Run lstm.train once for the rendered (line, filename base) pairs,
+    # with their pages in a multi-page tif, and split the .lstmf into the
+    # files of the lines. Returns the pairs with a .lstmf.
+    # samples: the metrics of the lines
+    todo_samples = [samples[line] for line, filename_base in todo]
+    if len(todo) <= 1:
+        for line, filename_base in todo:
+            result = yield lstm_train_cmd(filename_base, params)
+            share_step(todo_samples, 'train_seconds', result)
+            if result:
+                return todo
+            samples[line]['error'] = 'train_' + result.error
+        return []
+    train_base = os.path.join(batch_dir, 'train')
+    images = []
+    try:
+        with open(train_base + '.box', 'w', encoding='utf-8') as w:
+            for page, (line, filename_base) in enumerate(todo):
+                with open(filename_base + '.box', 'r', encoding='utf-8') as f:
+                    for ln in f:
+                        ln = ln.rstrip('\n')
+                        if ln:
+                            w.write('%s %d\n' % (ln.rsplit(' ', 1)[0], page))
+                images.append(Image.open(filename_base + '.tif'))
+        save_args = {k: images[0].info[k] for k in ('compression', 'dpi')
+                     if k in images[0].info}
+        images[0].save(train_base + '.tif', save_all=True,
+                       append_images=images[1:], **save_args)
+    finally:
+        for im in images:
+            im.close()
+    result = yield lstm_train_cmd(train_base, params)
+    share_step(todo_samples, 'train_seconds', result)
+    if not result:
+        for sample in todo_samples:
+            sample['error'] = 'train_' + result.error
+        return []
+    pages = read_lstmf_pages(train_base + '.lstmf')
+    if pages is None:
+        print('Unknown .lstmf format, training the lines one by one.')
+        for sample in todo_samples:
+            sample['error'] = 'train_split'
+        return []
+    done = []
+    for page, (line, filename_base) in enumerate(todo):
+        if page not in pages:
+            samples[line]['error'] = 'train_split'
+            continue
+        name, data = pages[page]
+        if name == train_base + '.tif':
+            name = filename_base + '.tif'
+        write_lstmf_page(filename_base + '.lstmf', name, data)
+        done.append((line, filename_base))
+    return done
+
+
+def generate_line_imgs_steps(path, font, lines, tmpdir, vertical=False,
+                             renderer=None, metrics=None):
+    # Render lines with the same font and parameters in one text2image call
+    # or with the renderer, train them with one lstm.train, and fall back
+    # to the lines one by one for the ones that failed.
+    results = {}
+    samples = {}
+    todo = []
+    for line in dict.fromkeys(lines):
+        filename_base = line_filename_base(path, font, line)
+        os.makedirs(os.path.dirname(filename_base), exist_ok=True)
+        if is_rendered(filename_base):
+            results[line] = filename_base
+        elif line.strip():
+            todo.append((line, filename_base))
+    if todo:
+        params = render_params(font, todo[0][0], vertical)
+        for line, filename_base in todo:
+            samples[line] = new_sample(
+                filename_base, font, line, params, len(todo))
+        with tempfile.TemporaryDirectory(
+            prefix='t2ibatch_', dir=TMP_DIR
+        ) as batch_dir:
+            rendered = []
+            if renderer is not None:
+                futures = []
+                for line, filename_base in todo:
+                    remove_outputs(filename_base)
+                    with open(filename_base + '.txt', 'w',
+                              encoding='utf-8') as f:
+                        f.write(line)
+                    future = renderer.submit(
+                        filename_base, font, line, params)
+                    if future is not None:
+                        futures.append(((line, filename_base), future))
+                # the renders run in parallel, so their time is shared
+                render_samples = []
+                seconds = 0.0
+                for (line, filename_base), future in futures:
+                    sample = samples[line]
+                    sample['attempts'] += 1
+                    sample['renderer'] = 'pil'
+                    render_samples.append(sample)
+                    result = yield future
+                    seconds += result.seconds
+                    if result:
+                        rendered.append((line, filename_base))
+                    else:
+                        sample['error'] = 'render_' + result.error
+                share_step(render_samples, 'render_seconds',
+                           StepResult(True, seconds))
+            else:
+                batch_base = os.path.join(batch_dir, 'batch')
+                with open(batch_base + '.txt', 'w', encoding='utf-8') as f:
+                    for line, filename_base in todo:
+                        f.write(line)
+                        f.write('\n')
+                result = yield text2image_cmd(
+                    batch_base + '.txt', batch_base, font, params, tmpdir)
+                share_step(samples.values(), 'render_seconds', result)
+                for sample in samples.values():
+                    sample['attempts'] += 1
+                    sample['renderer'] = 'text2image'
+                    if not result:
+                        sample['error'] = 'render_' + result.error
+                    else:
+                        # not on a page of its own
+                        sample['error'] = 'render_page'
+                if result and os.path.isfile(batch_base + '.tif'):
+                    rendered = list(split_batch_pages(batch_base, todo))
+                    for line, filename_base in rendered:
+                        samples[line]['error'] = None
+            for line, filename_base in (yield from lstm_train_batch_steps(
+                rendered, params, batch_dir, samples
+            )):
+                sample = samples[line]
+                sample['error'] = finish_line_img(filename_base)
+                if sample['error'] is None:
+                    results[line] = filename_base
+                    if metrics is not None:
+                        metrics.add(sample)
+    for line in lines:
+        if line not in results:
+            results[line] = yield from generate_line_img_steps(
+                path, font, line, tmpdir, vertical, metrics=metrics,
+                sample=samples.get(line))
+    return [results[line] for line in lines]
+
+
+def render_task_steps(path, font, lines, tmpdir, vertical, batch,
+                      renderer=None, metrics=None):
+    if batch:
+        return (yield from generate_line_imgs_steps(
+            path, font, lines, tmpdir, vertical, renderer, metrics))
+    return [(yield from generate_line_img_steps(
+        path, font, lines[0], tmpdir, vertical, renderer, metrics))]
+
+
+def render_tasks_threaded(tasks, render, handle_result, report, jobs,
+                          make_fc_dir, interval):
+    # a fontconfig directory for each worker
+    local = threading.local()
+
+    def init_worker():
+        local.tmpdir = make_fc_dir()
+
+    def run(task):
+        return run_steps(render(*task, local.tmpdir))
+
+    with concurrent.futures.ThreadPoolExecutor(
+        jobs, initializer=init_worker
+    ) as executor:
+        running = {}
+        while True:
+            # keep the workers busy with a bounded queue
+            for task in itertools.islice(tasks, jobs * 2 - len(running)):
+                running[executor.submit(run, task)] = task
+            if not running:
+                break
+            finished, _ = concurrent.futures.wait(
+                running, timeout=interval,
+                return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                handle_result(running.pop(future), future.result())
+            report()
+
+
+async def render_tasks_async(tasks, render, handle_result, report, jobs,
+                             make_fc_dir, interval):
+    # Each task runs as a coroutine, so the text2image of a line overlaps
+    # with the lstm.train of another. The limiter decides how many training
+    # tools run at once.
+    limiter = ProcessLimiter(jobs)
+    # a fontconfig directory for each running task
+    fc_dirs = asyncio.Queue()
+    for i in range(jobs * 2):
+        fc_dirs.put_nowait(make_fc_dir())
+
+    async def run(task):
+        fc_dir = await fc_dirs.get()
+        try:
+            return await run_steps_async(render(*task, fc_dir), limiter)
+        finally:
+            fc_dirs.put_nowait(fc_dir)
+
+    running = {}
+    while True:
+        for task in itertools.islice(tasks, jobs * 2 - len(running)):
+            running[asyncio.ensure_future(run(task))] = task
+        if not running:
+            break
+        finished, _ = await asyncio.wait(
+            running, timeout=interval, return_when=asyncio.FIRST_COMPLETED)
+        for future in finished:
+            handle_result(running.pop(future), future.result())
+        report()
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '%d:%02d:%02d' % (hours, minutes, seconds)
+
+
+class RenderProgress:
+    def __init__(self, total, interval=10):
+        # total: number of sampled pairs
+        self.total = total
+        self.interval = interval
+        self.done = self.rendered = self.failed = 0
+        self.start = self.last_report = time.monotonic()
+
+    def update(self, rendered=0, skipped=0, failed=0):
+        self.rendered += rendered
+        self.failed += failed
+        self.done += rendered + skipped + failed
+
+    def report(self, force=False):
+        now = time.monotonic()
+        if not force and now - self.last_report < self.interval:
+            return False
+        self.last_report = now
+        rate = self.rendered / max(now - self.start, 1e-6)
+        if rate:
+            eta = format_duration(max(self.total - self.done, 0) / rate)
+        else:
+            eta = '-'
+        print(' %d/%d images, %d failed, %.1f renders/s, ETA %s' % (
+            self.done, self.total, self.failed, rate, eta))
+        return True
+
+
+class RenderMetrics:
+    # Per-line render metrics: appended to a JSON-lines log and summed by
+    # font and by failure class for the summary at the end of the run.
+    def __init__(self, filename=None):
+        self.file = None
+        if filename:
+            # line buffered, an interrupted run keeps its records
+            self.file = open(filename, 'a', encoding='utf-8', buffering=1)
+        self.lock = threading.Lock()
+        self.fonts = collections.defaultdict(collections.Counter)
+        self.errors = collections.defaultdict(collections.Counter)
+
+    def add(self, sample):
+        record = {'time': round(time.time(), 3)}
+        record.update(sample)
+        record['retries'] = max(record.pop('attempts') - 1, 0)
+        for key in ('render_seconds', 'train_seconds'):
+            record[key] = round(record[key], 4)
+        for ext in ('.tif', '.lstmf'):
+            try:
+                size = os.path.getsize(sample['sample'] + ext)
+            except OSError:
+                size = 0
+            record[ext[1:] + '_bytes'] = size
+        with self.lock:
+            if self.file is not None:
+                self.file.write(json.dumps(record, ensure_ascii=False))
+                self.file.write('\n')
+            stats = self.fonts[record['font']]
+            stats['lines'] += 1
+            stats['failed'] += record['error'] is not None
+            stats['retries'] += record['retries']
+            stats['render_seconds'] += record['render_seconds']
+            stats['train_seconds'] += record['train_seconds']
+            if record['error'] is not None:
+                self.errors[record['error']][record['font']] += 1
+
+    def summary(self):
+        if not self.fonts:
+            return
+        print('Render time by font:')
+        print(' %7s %6s %7s %9s %9s %7s  %s' % (
+            'lines', 'failed', 'retries', 'render s', 'train s', 's/line',
+            'font'))
+        for font, stats in sorted(
+            self.fonts.items(),
+            key=lambda x: -(x[1]['render_seconds'] + x[1]['train_seconds'])
+        ):
+            seconds = stats['render_seconds'] + stats['train_seconds']
+            print(' %7d %6d %7d %9.1f %9.1f %7.3f  %s' % (
+                stats['lines'], stats['failed'], stats['retries'],
+                stats['render_seconds'], stats['train_seconds'],
+                seconds / stats['lines'], font))
+        if self.errors:
+            print('Failures by class:')
+        for error, fonts in sorted(
+            self.errors.items(), key=lambda x: -sum(x[1].values())
+        ):
+            print(' %s: %d (%s)' % (error, sum(fonts.values()), ', '.join(
+                '%s: %d' % x for x in fonts.most_common(3))))
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+class WorkQueue:
+    # Render tasks shared by a coordinator and the --worker processes, on
+    # storage shared by all of them. The workers claim tasks, render them
+    # into the shared image directories and store the results, and the
+    # coordinator adds the results to the manifest. A claim expires if the
+    # worker stops sending heartbeats.
+    def __init__(self, filename, lease=QUEUE_LEASE, poll=5):
+        # no WAL, it needs shared memory between the hosts
+        self.filename = filename
+        self.db = sqlite3.connect(filename, timeout=60, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=DELETE')
+        self.lease = lease
+        self.poll = poll
+        self.worker = '%s:%d' % (socket.gethostname(), os.getpid())
+        with self.transaction():
+            self.db.execute("""
+                CREATE TABLE IF NOT EXISTS tasks (
+                    id INTEGER PRIMARY KEY,
+                    path TEXT NOT NULL,
+                    font TEXT NOT NULL,
+                    lines TEXT NOT NULL,
+                    vertical INTEGER NOT NULL,
+                    batch INTEGER NOT NULL,
+                    state TEXT NOT NULL,
+                    worker TEXT,
+                    heartbeat REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    results TEXT
+                )""")
+            self.db.execute(
+                'CREATE INDEX IF NOT EXISTS idx_tasks_state '
+                'ON tasks (state, id)')
+            self.db.execute("""
+                CREATE TABLE IF NOT EXISTS queue_state (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL
+                )""")
+
+    @contextlib.contextmanager
+    def transaction(self):
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self.db.execute('ROLLBACK')
+            raise
+        self.db.execute('COMMIT')
+
+    def get_state(self, key):
+        row = self.db.execute(
+            'SELECT value FROM queue_state WHERE key = ?', (key,)).fetchone()
+        return row and row[0]
+
+    def start(self, tool_version, fonts_dir=''):
+        # the workers must render with the same tools and fonts, and use the
+        # lease of the coordinator
+        with self.transaction():
+            self.db.executemany('REPLACE INTO queue_state VALUES (?,?)', (
+                ('tool_version', tool_version), ('lease', str(self.lease)),
+                ('fonts_dir', fonts_dir), ('finished', '0')))
+
+    def finish(self):
+        # no more tasks, the idle workers exit
+        with self.transaction():
+            self.db.execute(
+                "REPLACE INTO queue_state VALUES ('finished', '1')")
+
+    def add_tasks(self, path, vertical, batch, tasks):
+        # (font, lines) tasks of a path, replacing those of an earlier run
+        with self.transaction():
+            self.db.execute('DELETE FROM tasks WHERE path = ?', (path,))
+            self.db.executemany(
+                'INSERT INTO tasks (path, font, lines, vertical, batch, '
+                "state) VALUES (?,?,?,?,?,'todo')",
+                ((path, font, json.dumps(lines, ensure_ascii=False),
+                  vertical, batch) for font, lines in tasks))
+
+    def claim(self):
+        # (id, path, font, lines, vertical, batch) of the next task, or None
+        now = time.time()
+        with self.transaction():
+            row = self.db.execute(
+                'SELECT id, path, font, lines, vertical, batch FROM tasks '
+                "WHERE state = 'todo' ORDER BY id LIMIT 1").fetchone()
+            if row is None:
+                row = self.db.execute(
+                    'SELECT id, path, font, lines, vertical, batch FROM tasks '
+                    "WHERE state = 'claimed' AND heartbeat < ? "
+                    'AND attempts < ? ORDER BY id LIMIT 1',
+                    (now - self.lease, QUEUE_ATTEMPTS)).fetchone()
+            if row is None:
+                return None
+            self.db.execute(
+                "UPDATE tasks SET state = 'claimed', worker = ?, "
+                'heartbeat = ?, attempts = attempts + 1 WHERE id = ?',
+                (self.worker, now, row[0]))
+        return (row[0], row[1], row[2], json.loads(row[3]), bool(row[4]),
+                bool(row[5]))
+
+    def heartbeat(self):
+        with self.transaction():
+            self.db.execute(
+                'UPDATE tasks SET heartbeat = ? '
+                "WHERE state = 'claimed' AND worker = ?",
+                (time.time(), self.worker))
+
+    def complete(self, task_id, results):
+        # results: the filename base of each line, None if it failed. Lost if
+        # the claim expired and another worker has the task.
+        with self.transaction():
+            self.db.execute(
+                "UPDATE tasks SET state = 'done', results = ? "
+                "WHERE id = ? AND worker = ? AND state = 'claimed'",
+                (json.dumps(results), task_id, self.worker))
+
+    def pending(self, path):
+        return self.db.execute(
+            'SELECT COUNT(*) FROM tasks WHERE path = ? AND '
+            "(state = 'todo' OR state = 'claimed' AND (heartbeat >= ? "
+            'OR attempts < ?))',
+            (path, time.time() - self.lease, QUEUE_ATTEMPTS)).fetchone()[0]
+
+    def collect(self, path):
+        # ((font, lines), results) of the finished tasks of the path, and
+        # of the tasks given up after their workers died too many times
+        finished = []
+        with self.transaction():
+            for task_id, font, lines, state, results in self.db.execute(
+                'SELECT id, font, lines, state, results FROM tasks '
+                "WHERE path = ? AND (state = 'done' OR state = 'claimed' "
+                'AND heartbeat < ? AND attempts >= ?)',
+                (path, time.time() - self.lease, QUEUE_ATTEMPTS)
+            ).fetchall():
+                lines = json.loads(lines)
+                if state == 'done':
+                    results = json.loads(results)
+                else:
+                    results = [None] * len(lines)
+                finished.append(((font, lines), results))
+                self.db.execute(
+                    "UPDATE tasks SET state = 'collected' WHERE id = ?",
+                    (task_id,))
+        return finished
+
+    def close(self):
+        self.db.close()
+
+
+def collect_queue(queue, path, handle_result, report):
+    # wait for the workers to render the tasks of the path
+    while True:
+        # before collecting, so that no task finishes unseen
+        pending = queue.pending(path)
+        for task, results in queue.collect(path):
+            handle_result(task, results)
+        report()
+        if not pending:
+            break
+        time.sleep(queue.poll)
+
+
+def run_worker(queue, scheduler='threads', jobs=None, renderer=None,
+               metrics=None):
+    # Render the tasks of the queue until the coordinator finishes it. Runs
+    # in the working directory of the coordinator, on the shared storage.
+    version = queue.get_state('tool_version')
+    while version is None:
+        print('Waiting for the coordinator...')
+        time.sleep(queue.poll)
+        version = queue.get_state('tool_version')
+    if version != tool_version():
+        print('The training tools differ from the coordinator\'s: %s' %
+              version)
+        return False
+    queue.lease = float(queue.get_state('lease'))
+    # the font subsets of the coordinator
+    fonts_dir = queue.get_state('fonts_dir')
+    if fonts_dir:
+        global RENDER_FONTS_DIR
+        RENDER_FONTS_DIR = os.path.abspath(fonts_dir)
+    jobs = jobs or default_jobs(scheduler)
+    done = collections.Counter()
+
+    def render(task_id, path, font, lines, vertical, batch, tmpdir):
+        return render_task_steps(
+            path, font, lines, tmpdir, vertical, batch, renderer, metrics)
+
+    def handle_result(task, results):
+        queue.complete(task[0], results)
+        done['tasks'] += 1
+        done['lines'] += sum(1 for x in results if x)
+        done['failed'] += sum(1 for x in results if not x)
+
+    # The heartbeats run in a thread of their own with another connection,
+    # as the queue may stay locked by another worker for a while, which
+    # would hold up the event loop of the asyncio scheduler.
+    heartbeats = concurrent.futures.ThreadPoolExecutor(1)
+    beat_queue = beat = None
+
+    def heartbeat():
+        nonlocal beat_queue
+        if beat_queue is None:
+            beat_queue = WorkQueue(queue.filename, queue.lease, queue.poll)
+        beat_queue.heartbeat()
+
+    def close_heartbeats():
+        if beat_queue is not None:
+            beat_queue.close()
+
+    last_report = time.monotonic()
+
+    def report():
+        nonlocal last_report, beat
+        if beat is None or beat.done():
+            if beat is not None and beat.exception() is not None:
+                print('Heartbeat error: %s' % beat.exception())
+            beat = heartbeats.submit(heartbeat)
+        now = time.monotonic()
+        if now - last_report >= 10:
+            last_report = now
+            print(' %(tasks)d tasks, %(lines)d images, %(failed)d failed'
+                  % done)
+
+    with tempfile.TemporaryDirectory(prefix='t2ifc_', dir=TMP_DIR) as tmpdir:
+        # other hosts may build another cache in the shared directory
+        fc_cache = fontconfig_cache(os.path.join(tmpdir, FC_CACHE_DIR))
+
+        def make_fc_dir():
+            fc_dir = tempfile.mkdtemp(dir=tmpdir)
+            if fc_cache:
+                copy_fontconfig_cache(fc_cache, fc_dir)
+            return fc_dir
+
+        while True:
+            task = queue.claim()
+            if task is None:
+                if queue.get_state('finished') == '1':
+                    break
+                time.sleep(queue.poll)
+                continue
+            tasks = itertools.chain((task,), iter(queue.claim, None))
+            if scheduler == 'asyncio':
+                asyncio.run(render_tasks_async(
+                    tasks, render, handle_result, report, jobs, make_fc_dir,
+                    queue.poll))
+            else:
+                render_tasks_threaded(
+                    tasks, render, handle_result, report, jobs, make_fc_dir,
+                    queue.poll)
+    # the connection is closed in its own thread
+    heartbeats.submit(close_heartbeats)
+    heartbeats.shutdown()
+    print('Rendered %(lines)d images in %(tasks)d tasks, %(failed)d failed.'
+          % done)
+    return True
+
+
+def default_jobs(scheduler):
+    if scheduler == 'asyncio':
+        return os.cpu_count()
+    return max(1, round(os.cpu_count() * 0.4))
+
+
+def generate_imgs(path, fonts, lines, vertical, manifest, batch_size=1,
+                  rebuild=False, scheduler='threads', jobs=None, pairs=None,
+                  coverage=None, renderer=None, metrics=None, queue=None):
+    # pairs: only render these sampled (line, font) pairs
+    # coverage: FontCoverage to skip the lines a font cannot render
+    # renderer: PILRenderer to use instead of text2image
+    # metrics: RenderMetrics of the rendered lines
+    # queue: WorkQueue for the workers to render the tasks instead
     print('Generating images in %s...' % path)
     # shutil.rmtree(path)
     os.makedirs(path, exist_ok=True)
+    if batch_size > 1 and Image is None:
+        print('PIL not found, rendering lines one by one.')
+        batch_size = 1
+    if rebuild:
+        manifest.rebuild(path, fonts, lines, vertical)
+    if pairs is None:
+        # one font at a time, to fill the batches
+        pairs = sample_pairs(lines, fonts, batch_size > 1)
+    if len(pairs) > len(lines):
+        # one query for most of the dataset
+        completed = manifest.completed(path).get
+    else:
+        completed = manifest.render_state
     filenames = []
-    total = len(fonts) * len(lines)
-    jobs = round(os.cpu_count() * 0.4)
-    with multiprocessing.dummy.Pool(jobs) as pool:
-        with tempfile.TemporaryDirectory(prefix='t2ifc_', dir=TMP_DIR) as tmpdir:
-            tmpdirs = []
-            for i in range(jobs * 5):
-                dirname = os.path.join(tmpdir, '%03d' % i)
-                os.mkdir(dirname)
-                tmpdirs.append(dirname)
-            i = 0
-            tmpdir_num = len(tmpdirs)
-            for chunk in grouper_it(250, itertools.product(lines, fonts)):
-                futures = []
-                for line, (font, ratio) in chunk:
-                    if line_hash_num(line, font) < ratio:
-                        futures.append(pool.apply_async(
-                            generate_line_img,
-                            (path, font, line, tmpdirs[i % tmpdir_num], vertical)
-                        ))
-                        i += 1
-                for future in futures:
-                    result = future.get()
-                    if result:
-                        filenames.append(result + '.lstmf')
-                    if len(filenames) % 500 == 0:
-                        print(' %d/%d' % (len(filenames), total))
+    progress = RenderProgress(len(pairs))
+
+    uncovered = collections.Counter()
+
+    def iter_tasks():
+        # (font, lines) to render, the completed pairs are added directly
+        batches = collections.defaultdict(list)
+        for line, font in pairs:
+            if coverage is not None and not coverage.covers(font, line):
+                uncovered[font] += 1
+                progress.update(skipped=1)
+                continue
+            params = render_params(font, line, vertical)
+            filename_base = line_filename_base(path, font, line)
+            done = completed(filename_base)
+            if done == (params_key(params), manifest.tool_version):
+                filenames.append(filename_base + '.lstmf')
+                progress.update(skipped=1)
+                continue
+            elif done:
+                # rendered with other parameters or tools
+                remove_outputs(filename_base)
+            if batch_size == 1:
+                yield font, (line,)
+                continue
+            batch = batches[font, params]
+            batch.append(line)
+            if len(batch) >= batch_size:
+                yield font, batches.pop((font, params))
+        for (font, params), batch in batches.items():
+            yield font, batch
+
+    def render(font, task_lines, tmpdir):
+        return render_task_steps(
+            path, font, task_lines, tmpdir, vertical, batch_size > 1,
+            renderer, metrics)
+
+    def handle_result(task, results):
+        font, task_lines = task
+        for line, result in zip(task_lines, results):
+            if not result:
+                manifest.remove(line_filename_base(path, font, line))
+                progress.update(failed=1)
+                continue
+            manifest.add(path, result, font,
+                         render_params(font, line, vertical))
+            filenames.append(result + '.lstmf')
+            progress.update(rendered=1)
+
+    def report():
+        if progress.report():
+            manifest.commit()
+
+    if queue is not None:
+        queue.add_tasks(path, vertical, batch_size > 1, iter_tasks())
+        print('Queued the tasks, waiting for the workers...')
+        collect_queue(queue, path, handle_result, report)
+    else:
+        fc_cache = fontconfig_cache()
+        with tempfile.TemporaryDirectory(
+            prefix='t2ifc_', dir=TMP_DIR
+        ) as tmpdir:
+
+            def make_fc_dir():
+                fc_dir = tempfile.mkdtemp(dir=tmpdir)
+                if fc_cache:
+                    copy_fontconfig_cache(fc_cache, fc_dir)
+                return fc_dir
+
+            if scheduler == 'asyncio':
+                asyncio.run(render_tasks_async(
+                    iter_tasks(), render, handle_result, report,
+                    jobs or default_jobs(scheduler), make_fc_dir,
+                    progress.interval))
+            else:
+                render_tasks_threaded(
+                    iter_tasks(), render, handle_result, report,
+                    jobs or default_jobs(scheduler), make_fc_dir,
+                    progress.interval)
+    manifest.commit()
+    progress.report(True)
+    for font, count in sorted(uncovered.items()):
+        print(' %s: skipped %d lines with missing glyphs' % (font, count))
     print('Generated %s images.' % len(filenames))
     return filenames
 
 
-def generate_all_imgs(base_dir, fonts, src_lang, dst_lang):
-    vertical = dst_lang.endswith('_vert')
+def sharded_filename(filename, paths):
+    # path of a file of the flat <path>/<font>/<hash>.* layout in the shard
+    # directories, other paths are returned unchanged
+    font_dir, basename = os.path.split(filename)
+    if os.path.dirname(font_dir) not in paths:
+        return filename
+    name = os.path.splitext(basename)[0]
+    return os.path.join(font_dir, line_shard(name), basename)
+
+
+def migrate_layout(paths, manifest, list_files):
+    # Move the images of the flat layout into the shard directories, and
+    # update the manifest and the list files. Safe to rerun.
+    for path in paths:
+        if not os.path.isdir(path):
+            continue
+        print('Migrating %s to the sharded layout...' % path)
+        count = 0
+        with os.scandir(path) as it:
+            font_dirs = [entry.path for entry in it if entry.is_dir()]
+        for font_dir in font_dirs:
+            with os.scandir(font_dir) as it:
+                filenames = [entry.path for entry in it if entry.is_file()
+                             and os.path.splitext(entry.name)[1] in RENDER_EXTS]
+            for filename in filenames:
+                new_filename = sharded_filename(filename, paths)
+                os.makedirs(os.path.dirname(new_filename), exist_ok=True)
+                os.replace(filename, new_filename)
+                count += 1
+        for filename_base, in manifest.db.execute(
+            'SELECT filename_base FROM renders WHERE path = ?', (path,)
+        ).fetchall():
+            new_filename_base = sharded_filename(filename_base, paths)
+            if new_filename_base != filename_base:
+                manifest.move(filename_base, new_filename_base)
+        manifest.commit()
+        print('Moved %d files.' % count)
+    for list_file in list_files:
+        if not os.path.isfile(list_file):
+            continue
+        with open(list_file, 'r', encoding='utf-8') as f:
+            filenames = [sharded_filename(ln.rstrip('\n'), paths) for ln in f]
+        with open(list_file + '.tmp', 'w', encoding='utf-8') as f:
+            for ln in filenames:
+                f.write(ln)
+                f.write('\n')
+        os.replace(list_file + '.tmp', list_file)
+
+
+def is_valid_lstmf(filename, size):
+    # the size in the manifest, and a DocumentData starts with the number
+    # of pages
+    try:
+        with open(filename, 'rb') as f:
+            head = f.read(4)
+        return (os.stat(filename).st_size == size and len(head) == 4 and
+                int.from_bytes(head, 'little') > 0)
+    except FileNotFoundError:
+        return False
+
+
+def pack_lstmfs(path, manifest, shard_dir=LSTMF_SHARD_DIR,
+                shard_size=LSTMF_SHARD_SIZE, drop_images=False):
+    # Move the .lstmf files of the completed renders into tar archives of
+    # about shard_size bytes, indexed in the manifest. The loose files are
+    # removed after the archive is read back.
+    todo = manifest.to_pack(path)
+    pending = sorted(filename_base for filename_base, size in todo.items()
+                     if is_valid_lstmf(filename_base + '.lstmf', size))
+    if not pending:
+        return
+    print('Packing %d of %d images of %s...' % (
+        len(pending), len(todo), path))
+    os.makedirs(shard_dir, exist_ok=True)
+    prefix = os.path.basename(path) + '-'
+    number = 1 + max((int(name[len(prefix):-4]) for name in
+                      os.listdir(shard_dir) if name.startswith(prefix) and
+                      name.endswith('.tar')), default=-1)
+    pending = iter(pending)
+    filename_base = next(pending, None)
+    while filename_base:
+        shard = os.path.join(shard_dir, '%s%05d.tar' % (prefix, number))
+        number += 1
+        digests = {}
+        total = 0
+        with tarfile.open(shard, 'w') as tar:
+            while filename_base and total < shard_size:
+                filename = filename_base + '.lstmf'
+                with open(filename, 'rb') as f:
+                    data = f.read()
+                info = tar.gettarinfo(filename)
+                tar.addfile(info, io.BytesIO(data))
+                digests[info.name] = (filename_base, hashlib.blake2b(
+                    data, digest_size=20).digest())
+                total += len(data)
+                filename_base = next(pending, None)
+        verified = []
+        with tarfile.open(shard, 'r') as tar, open(shard, 'rb') as f:
+            for member in tar:
+                member_base, digest = digests[member.name]
+                f.seek(member.offset_data)
+                if hashlib.blake2b(
+                    f.read(member.size), digest_size=20
+                ).digest() == digest:
+                    manifest.add_packed(
+                        member_base, shard, member.offset_data, member.size)
+                    verified.append(member_base)
+        manifest.commit()
+        for member_base in verified:
+            os.remove(member_base + '.lstmf')
+            if drop_images:
+                remove_outputs(member_base, ('.tif', '.box'))
+        print(' %s: %d files, %d bytes' % (shard, len(verified), total))
+
+
+def unpack_lstmfs(manifest, list_files):
+    # write the missing .lstmf files of the lists from the shards
+    by_shard = collections.defaultdict(list)
+    missing = 0
+    for list_file in list_files:
+        with open(list_file, 'r', encoding='utf-8') as f:
+            for ln in f:
+                filename = ln.rstrip('\n')
+                if not filename or os.path.isfile(filename):
+                    continue
+                location = manifest.packed_location(
+                    os.path.splitext(filename)[0])
+                if location is None:
+                    missing += 1
+                    continue
+                shard, offset, size = location
+                by_shard[shard].append((offset, size, filename))
+    count = 0
+    for shard, members in sorted(by_shard.items()):
+        with open(shard, 'rb') as f:
+            for offset, size, filename in sorted(members):
+                f.seek(offset)
+                os.makedirs(os.path.dirname(filename), exist_ok=True)
+                with open(filename + '.tmp', 'wb') as w:
+                    w.write(f.read(size))
+                os.replace(filename + '.tmp', filename)
+                count += 1
+    print('Unpacked %d files, %d not found in the shards.' % (count, missing))
+
+
+def plan_dataset(prev_lines, prev_fonts, lines, fonts):
+    # The sampled (line, font) pairs to render and to remove after the
+    # lines or the font ratios changed, without sampling the unchanged ones.
+    prev_set = set(prev_lines)
+    current = dict.fromkeys(lines)
+    fonts = dict(fonts)
+    added = [line for line in current if line not in prev_set]
+    removed = [line for line in dict.fromkeys(prev_lines)
+               if line not in current]
+    kept = [line for line in current if line in prev_set]
+    render = sample_pairs(added, fonts.items())
+    remove = sample_pairs(removed, prev_fonts.items())
+    for font in dict.fromkeys(itertools.chain(prev_fonts, fonts)):
+        old = prev_fonts.get(font, 0)
+        new = fonts.get(font, 0)
+        if old == new:
+            continue
+        for line, num in zip(kept, line_hash_nums(kept, font)):
+            if old <= num < new:
+                render.append((line, font))
+            elif new <= num < old:
+                remove.append((line, font))
+    return render, remove
+
+
+def unrendered_pairs(path, prev_lines, prev_fonts, lines, fonts, manifest):
+    # The pairs of the kept lines, sampled both times, without a render in
+    # the manifest: their render failed or the font lacked glyphs. They are
+    # tried again, as a full run would.
+    prev_set = set(prev_lines)
+    kept = [line for line in dict.fromkeys(lines) if line in prev_set]
+    names = [line_hash(line) for line in kept]
+    completed = manifest.completed(path)
+    pairs = []
+    for font, ratio in dict(fonts).items():
+        ratio = min(ratio, prev_fonts.get(font, 0))
+        if not ratio:
+            continue
+        font_dir = os.path.join(path, font_to_filename(font))
+        for line, name, num in zip(kept, names, line_hash_nums(kept, font)):
+            if num < ratio and os.path.join(
+                    font_dir, line_shard(name), name) not in completed:
+                pairs.append((line, font))
+    return pairs
+
+
+def remove_orphans(path, source, pairs, manifest):
+    # remove the images of the pairs no source samples any more, returns
+    # their .lstmf paths
+    removed = set()
+    for line, font in pairs:
+        if manifest.is_wanted(source, path, font, line):
+            continue
+        filename_base = line_filename_base(path, font, line)
+        remove_outputs(filename_base)
+        manifest.remove(filename_base)
+        removed.add(filename_base + '.lstmf')
+    manifest.commit()
+    return removed
+
+
+def update_list_file(filename, added, removed):
+    # keep the order of the list, and insert the new files at random
+    # positions
+    with open(filename, 'r', encoding='utf-8') as f:
+        entries = [ln.rstrip('\n') for ln in f]
+    entries = [x for x in entries if x and x not in removed]
+    present = set(entries)
+    new = [x for x in dict.fromkeys(added) if x not in present]
+    random.shuffle(new)
+    total = len(entries) + len(new)
+    slots = set(random.sample(range(total), len(new)))
+    old_it = iter(entries)
+    new_it = iter(new)
+    with open(filename + '.tmp', 'w', encoding='utf-8') as f:
+        for i in range(total):
+            f.write(next(new_it) if i in slots else next(old_it))
+            f.write('\n')
+    os.replace(filename + '.tmp', filename)
+
+
+def char_inventory(lines):
+    # Sorted NFC characters of the lines, with the combining marks kept on
+    # their base character, for unicharset_extractor.
+    chars = set()
+    for line in lines:
+        chars.update(line)
+    marks = ''.join(sorted(
+        ch for ch in chars if ch in '\u200c\u200d' or
+        unicodedata.category(ch) in ('Mn', 'Mc', 'Me')))
+    units = {ch for ch in chars if ch not in marks and not ch.isspace()}
+    if marks:
+        cluster_re = re.compile(r'\S[%s]+' % re.escape(marks))
+        for line in lines:
+            units.update(cluster_re.findall(line))
+    return sorted({unicodedata.normalize('NFC', x) for x in units})
+
+
+def write_char_inventory(filename, units):
+    # Only rewritten when the inventory changed, so that make keeps the
+    # unicharset. Returns whether it changed.
+    data = ''.join(x + '\n' for x in units).encode('utf-8')
+    digest = hashlib.blake2b(data).digest()
+    with contextlib.suppress(FileNotFoundError):
+        with open(filename, 'rb') as f:
+            if hashlib.blake2b(f.read()).digest() == digest:
+                return False
+    with open(filename + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(filename + '.tmp', filename)
+    return True
+
+
+def read_texts(base_dir, src_lang):
+    # the lines of the train and test splits
     texts = [[], []]
-    lstmfs = [[], []]
     for i, txt in enumerate(('.lstm_train.txt', '.lstm_test.txt')):
         with open(os.path.join(base_dir, src_lang + txt), 'r') as f:
             texts[i] = [ln.strip() for ln in f.readlines()]
@@ -211,15 +2180,185 @@ def generate_all_imgs(base_dir, fonts, src_lang, dst_lang):
             # for i in range(2):
                 # for j in range(len(texts[i])):
                     # texts[i][j] = texts[i][j].translate(CHARMAP_V)
+    return texts
+
+
+def plan_digest(lines, fonts, prev=None):
+    # the inputs of a render plan: the lines and fonts, and those of the
+    # last run for an incremental plan
+    h = hashlib.blake2b(digest_size=20)
+    for line in sorted(set(lines)):
+        h.update(line.encode('utf-8') + b'\n')
+    h.update(repr(sorted(dict(fonts).items())).encode('utf-8'))
+    if prev is not None:
+        prev_lines, prev_fonts = prev
+        h.update(b'\0incremental\0')
+        for line in sorted(set(prev_lines)):
+            h.update(line.encode('utf-8') + b'\n')
+        h.update(repr(sorted(prev_fonts.items())).encode('utf-8'))
+    return h.hexdigest()
+
+
+def plan_split(source, path, lines, fonts, manifest, incremental,
+               by_font=False, saved=True):
+    # The digest of the inputs, and the pairs to render and to remove, from
+    # the saved plan of the same inputs if there is one.
+    prev = manifest.dataset(source, path) if incremental else None
+    digest = plan_digest(lines, fonts, prev)
+    pairs = manifest.saved_plan(source, path, digest) if saved else None
+    if pairs is not None:
+        print('%s %s: using the saved render plan.' % (source, path))
+        return (digest,) + pairs
+    if incremental:
+        render, remove = plan_dataset(prev[0], prev[1], lines, fonts)
+        retry = unrendered_pairs(
+            path, prev[0], prev[1], lines, fonts, manifest)
+        if retry:
+            print('%s %s: %d pairs not rendered by the last run' % (
+                source, path, len(retry)))
+        return digest, render + retry, remove
+    return digest, sample_pairs(lines, fonts, by_font), []
+
+
+def generate_all_imgs(base_dir, fonts, src_lang, dst_lang, manifest,
+                      batch_size=1, rebuild=False, scheduler='threads',
+                      jobs=None, incremental=False, coverage=None,
+                      renderer=None, metrics=None, queue=None):
+    # Returns the lines, the .lstmf files and the removed .lstmf files of
+    # each split. An incremental run only renders and returns the changes
+    # since the last run.
+    vertical = dst_lang.endswith('_vert')
+    texts = read_texts(base_dir, src_lang)
+    lstmfs = [[], []]
+    removed = [set(), set()]
 
     for i, name in enumerate(('train', 'test')):
+        path = 'img_' + name
         random.shuffle(texts[i])
-        lstmfs[i] = generate_imgs('img_' + name, fonts, texts[i], vertical)
+        digest, render, remove = plan_split(
+            src_lang, path, texts[i], fonts, manifest, incremental,
+            batch_size > 1, not rebuild)
+        if incremental:
+            print('%s %s: %d pairs to render, %d to remove' % (
+                src_lang, path, len(render), len(remove)))
+            removed[i] = remove_orphans(path, src_lang, remove, manifest)
+        lstmfs[i] = generate_imgs(
+            path, fonts, texts[i], vertical, manifest, batch_size, rebuild,
+            scheduler, jobs, render, coverage, renderer, metrics, queue)
+        manifest.drop_plan(src_lang, path)
+        manifest.save_dataset(src_lang, path, texts[i], fonts)
+
+    return texts, lstmfs, removed
+
+
+def render_history(filename=METRICS_FILE):
+    # {font: [lines, seconds]} of the renders in the metrics log
+    history = collections.defaultdict(lambda: [0, 0.0])
+    try:
+        f = open(filename, 'r', encoding='utf-8')
+    except FileNotFoundError:
+        return {}
+    with f:
+        for ln in f:
+            try:
+                record = json.loads(ln)
+                font = record['font']
+                seconds = record['render_seconds'] + record['train_seconds']
+            except (ValueError, KeyError, TypeError):
+                # the last line of an interrupted run
+                continue
+            history[font][0] += 1
+            history[font][1] += seconds
+    return dict(history)
+
+
+def estimate_plan(path, pairs, vertical, manifest, coverage=None):
+    # {font: Counter} of the planned pairs: already rendered with the same
+    # parameters and tools, not covered by the font, or to render
+    completed = manifest.completed(path)
+    stats = collections.defaultdict(collections.Counter)
+    for line, font in pairs:
+        counts = stats[font]
+        counts['pairs'] += 1
+        if coverage is not None and not coverage.covers(font, line):
+            counts['uncovered'] += 1
+            continue
+        params = render_params(font, line, vertical)
+        done = completed.get(line_filename_base(path, font, line))
+        if done == (params_key(params), manifest.tool_version):
+            counts['cached'] += 1
+        else:
+            counts['render'] += 1
+    return stats
+
+
+def print_plan(title, stats, history, jobs):
+    # The counts by font and the render time estimated from the seconds per
+    # line of each font in the metrics log, or of all fonts for a new font.
+    history_lines = sum(x[0] for x in history.values())
+    mean = None
+    if history_lines:
+        mean = sum(x[1] for x in history.values()) / history_lines
+    total = collections.Counter()
+    seconds = 0.0
+    unknown = False
+    print('%s:' % title)
+    print(' %8s %8s %9s %8s %9s  %s' % (
+        'pairs', 'cached', 'uncovered', 'render', 'est. s', 'font'))
+    for font, counts in sorted(stats.items()):
+        total.update(counts)
+        rate = mean
+        if font in history:
+            rate = history[font][1] / history[font][0]
+        if rate is None:
+            unknown = unknown or counts['render'] > 0
+            estimate = '-'
+        else:
+            seconds += counts['render'] * rate
+            estimate = '%.1f' % (counts['render'] * rate)
+        print(' %8d %8d %9d %8d %9s  %s' % (
+            counts['pairs'], counts['cached'], counts['uncovered'],
+            counts['render'], estimate, font))
+    cached = total['cached'] / max(total['pairs'], 1)
+    if unknown:
+        eta = 'unknown (no metrics yet)'
+    else:
+        eta = '%s with %d jobs' % (format_duration(seconds / jobs), jobs)
+    print(' %d pairs, %.1f%% cached, %d to render, ETA %s' % (
+        total['pairs'], cached * 100, total['render'], eta))
+    return total
+
 
-    return texts, lstmfs
+def plan_all_imgs(base_dir, fonts, src_lang, dst_lang, manifest,
+                  batch_size=1, incremental=False, coverage=None,
+                  history=None, jobs=1):
+    # Plan the renders of generate_all_imgs() without rendering, and save
+    # the plans for the next run. Returns {font: Counter} of all splits.
+    vertical = dst_lang.endswith('_vert')
+    texts = read_texts(base_dir, src_lang)
+    stats = collections.defaultdict(collections.Counter)
+    for i, name in enumerate(('train', 'test')):
+        path = 'img_' + name
+        random.shuffle(texts[i])
+        digest, render, remove = plan_split(
+            src_lang, path, texts[i], fonts, manifest, incremental,
+            batch_size > 1, False)
+        manifest.save_plan(src_lang, path, digest, render, remove)
+        split_stats = estimate_plan(path, render, vertical, manifest, coverage)
+        title = '%s %s' % (src_lang, path)
+        if incremental:
+            title += ' (%d pairs to remove)' % len(remove)
+        print_plan(title, split_stats, history or {}, jobs)
+        for font, counts in split_stats.items():
+            stats[font].update(counts)
+    return stats
 
 
-def main(lang, start_model, v3_model=None):
+def main(lang, start_model, v3_model=None, batch_size=1,
+         rebuild_manifest=False, scheduler='threads', jobs=None,
+         migrate=False, pack=False, drop_images=False, full=False,
+         renderer_name='text2image', metrics_file=METRICS_FILE, plan=False,
+         queue_file=None, subset_fonts=False):
     fonts_by_lang = []
     BASE_DIR = os.path.join(LANGDATA_DIR, lang)
 
@@ -243,6 +2382,39 @@ def main(lang, start_model, v3_model=None):
                 fonts_all[name] = ratio
         fonts_by_lang.append(l)
 
+    list_files = ['%s.lstmf_%s.list' % (lang, name)
+                  for name in ('train', 'test')]
+
+    def is_incremental(manifest):
+        # the lists and the manifest are of an earlier run
+        return (
+            not full and not rebuild_manifest and
+            all(os.path.isfile(x) for x in list_files) and
+            all(manifest.has_dataset(x) for x in src_langs))
+
+    def font_coverage(manifest):
+        if fontTools is None:
+            print('fontTools not found, not checking the font coverage.')
+            return None
+        return FontCoverage(manifest.db)
+
+    if plan:
+        manifest = RenderManifest()
+        coverage = font_coverage(manifest)
+        history = render_history(metrics_file)
+        stats = collections.defaultdict(collections.Counter)
+        for src_lang, fontlist in zip(src_langs, fonts_by_lang):
+            for font, counts in plan_all_imgs(
+                os.path.join(LANGDATA_DIR, src_lang), fontlist, src_lang,
+                lang, manifest, batch_size, is_incremental(manifest),
+                coverage, history, jobs or default_jobs(scheduler)
+            ).items():
+                stats[font].update(counts)
+        manifest.close()
+        print_plan('Total', stats, history, jobs or default_jobs(scheduler))
+        print('Saved the render plan for the next run.')
+        return
+
     for filename in (
         '.fontlist_lstm.txt', '.config', '.unicharambigs',
         '.word', '.freq', '.number', '.punc'
@@ -275,25 +2447,77 @@ def main(lang, start_model, v3_model=None):
         ), check=True)
 
 
+    if migrate:
+        manifest = RenderManifest()
+        migrate_layout(('img_train', 'img_test'), manifest, [
+            '%s.lstmf_%s.list' % (lang, name) for name in ('train', 'test')])
+        manifest.close()
+
+    text_files = [
+        os.path.join(LANGDATA_DIR, src_lang, src_lang + txt)
+        for src_lang in src_langs
+        for txt in ('.lstm_train.txt', '.lstm_test.txt')]
+    inventory_lines = None
     if any((
         check_mtime(os.path.join(LANGDATA_DIR,
             src_lang, src_lang + '.lstm_train.txt'), lang + '.lstmf_train.list') or
         check_mtime(os.path.join(LANGDATA_DIR,
             src_lang, src_lang + '.lstm_test.txt'), lang + '.lstmf_test.list')
-    ) for src_lang in src_langs):
+    ) for src_lang in src_langs) or any(
+        check_mtime(fontlist, list_file)
+        for fontlist in fontlists for list_file in list_files
+    ):
 
         texts = [set(), set()]
         lstmfs = [set(), set()]
+        removed = [set(), set()]
+        manifest = RenderManifest()
+        incremental = is_incremental(manifest)
+        coverage = font_coverage(manifest)
+        fonts_dir = ''
+        if subset_fonts and coverage is not None:
+            texts_all = itertools.chain.from_iterable(
+                read_texts(os.path.join(LANGDATA_DIR, x), x)
+                for x in src_langs)
+            fonts_dir = build_font_subsets(
+                coverage, fonts_all,
+                training_charset(texts_all, lang + '.punc'), jobs)
+            global RENDER_FONTS_DIR
+            RENDER_FONTS_DIR = os.path.abspath(fonts_dir)
+        renderer = queue = None
+        if queue_file:
+            queue = WorkQueue(queue_file)
+            queue.start(manifest.tool_version, fonts_dir)
+        elif renderer_name == 'pil':
+            if coverage is None or line_renderer is None:
+                print('PIL or fontTools not found, using text2image.')
+            else:
+                renderer = PILRenderer(coverage, jobs)
+        metrics = RenderMetrics(metrics_file)
         for src_lang, fontlist in zip(src_langs, fonts_by_lang):
-            l_texts, l_lstmfs = generate_all_imgs(
-                os.path.join(LANGDATA_DIR, src_lang), fontlist, src_lang, lang)
+            l_texts, l_lstmfs, l_removed = generate_all_imgs(
+                os.path.join(LANGDATA_DIR, src_lang), fontlist, src_lang, lang,
+                manifest, batch_size, rebuild_manifest, scheduler, jobs,
+                incremental, coverage, renderer, metrics, queue)
             for i in range(len(texts)):
                 texts[i].update(l_texts[i])
                 lstmfs[i].update(l_lstmfs[i])
+                removed[i].update(l_removed[i])
+        if renderer is not None:
+            renderer.close()
+        if queue is not None:
+            queue.finish()
+            queue.close()
+        metrics.summary()
+        metrics.close()
+        manifest.close()
         print('Total lines %s/%s' % (len(texts[0]), len(texts[1])))
 
         for i, name in enumerate(('train', 'test')):
-            with open('%s.lstmf_%s.list' % (lang, name), 'w', encoding='utf-8') as f:
+            if incremental:
+                update_list_file(list_files[i], lstmfs[i], removed[i])
+                continue
+            with open(list_files[i], 'w', encoding='utf-8') as f:
                 lstmf = list(lstmfs[i])
                 random.shuffle(lstmf)
                 for ln in lstmf:
@@ -304,18 +2528,33 @@ def main(lang, start_model, v3_model=None):
                     # f.write(ln)
                     # f.write('\n')
 
+        # the old input of unicharset_extractor
         with contextlib.suppress(FileNotFoundError):
             os.remove(lang + '.fake.box')
 
-        with open(lang + '.fake.box', 'w', encoding='utf-8') as f:
-            line_num = 0
-            for i in range(2):
-                for ln in texts[i]:
-                    for j, ch in enumerate(ln):
-                        f.write('%s %d 100 %d 150 %d' % (
-                            ch, 100+j*50, 150+j*50, line_num))
-                        f.write('\n')
-                    line_num += 1
+        inventory_lines = texts[0] | texts[1]
+    elif any(check_mtime(x, lang + '.chars.txt') for x in text_files):
+        # the lists are current, but the inventory is missing or older
+        # than the texts
+        inventory_lines = set()
+        for src_lang in src_langs:
+            for split in read_texts(
+                    os.path.join(LANGDATA_DIR, src_lang), src_lang):
+                inventory_lines.update(split)
+
+    if inventory_lines is not None:
+        if write_char_inventory(
+            lang + '.chars.txt', char_inventory(inventory_lines)
+        ):
+            print('Updated the character inventory.')
+        else:
+            print('Character inventory unchanged.')
+
+    if pack:
+        manifest = RenderManifest()
+        for name in ('train', 'test'):
+            pack_lstmfs('img_' + name, manifest, drop_images=drop_images)
+        manifest.close()
 
     with open('Makefile', 'w') as w:
         w.write(f'TRAIN_LANG={lang}\n')
@@ -323,13 +2562,14 @@ def main(lang, start_model, v3_model=None):
         w.write('TESSERACT=$(TRAINING_BIN)/tesseract\n')
         w.write(f'LANGDATA_DIR={LANGDATA_DIR}\n')
         w.write(f'export TESSDATA_PREFIX:={TESSDATA_PREFIX}\n')
+        w.write(f'CONFIGURE_LSTM={os.path.abspath(__file__)}\n')
         w.write('\nDEBUG_INTERVAL:=0\n')
         w.write('LEARNING_RATE:=0.0005\n')
         w.write('MAX_ITERATIONS:=5000000\n')
         w.write('TARGET_ERROR_RATE:=0.01\n')
         w.write(f'\nLAST_CHECKPOINT=checkpoints/{lang}_checkpoint\n')
         w.write(f'PROTO_MODEL=proto_model/{lang}.traineddata\n')
-        w.write('\n\n.PHONY: clean\n\n')
+        w.write('\n\n.PHONY: clean lstmf\n\n')
         w.write('\n\n.PRECIOUS: $(LAST_CHECKPOINT)\n\n')
         w.write(f'all: {lang}.traineddata\n\n')
         w.write(f'traineddata: {lang}.traineddata\n\n')
@@ -350,8 +2590,8 @@ def main(lang, start_model, v3_model=None):
         deps = ''
         if v3_model:
             deps += f' v3_model/{lang}.unicharset'
-        w.write(f'\n\nunicharset: {lang}.fake.box{deps}\n')
-        w.write(f'\t$(TRAINING_BIN)/unicharset_extractor --output_unicharset 1.unicharset --norm_mode 2 {lang}.fake.box && \\\n')
+        w.write(f'\n\nunicharset: {lang}.chars.txt{deps}\n')
+        w.write(f'\t$(TRAINING_BIN)/unicharset_extractor --output_unicharset 1.unicharset --norm_mode 2 {lang}.chars.txt && \\\n')
         w.write('\t$(TRAINING_BIN)/set_unicharset_properties -U 1.unicharset -O 2.unicharset --script_dir=$(LANGDATA_DIR) && \\\n')
         if deps:
             w.write(f'\t$(TRAINING_BIN)/merge_unicharsets 2.unicharset {deps} 3.unicharset && \\\n')
@@ -364,10 +2604,14 @@ def main(lang, start_model, v3_model=None):
         w.write(f'\t$(TRAINING_BIN)/combine_lang_model --input_unicharset unicharset --script_dir $(LANGDATA_DIR) --numbers {lang}.number --puncs {lang}.punc --words {lang}.word --output_dir . --lang {lang} && \\\n')
         w.write(f'\t\trm -rf proto_model && mv {lang} proto_model\n\n')
 
-        w.write(f'start_training: $(PROTO_MODEL) start_model/{lang}.lstm {lang}.lstmf_train.list {lang}.lstmf_test.list\n')
+        # the .lstmf files in the lists may be packed in the shards
+        w.write('lstmf:\n')
+        w.write(f'\tpython3 $(CONFIGURE_LSTM) --unpack-shards {lang} start_{lang}.traineddata\n\n')
+        lstmf_dep = ' lstmf' if pack or os.path.isdir(LSTMF_SHARD_DIR) else ''
+        w.write(f'start_training: $(PROTO_MODEL) start_model/{lang}.lstm {lang}.lstmf_train.list {lang}.lstmf_test.list{lstmf_dep}\n')
         w.write('\t@mkdir -p checkpoints\n')
         w.write(f'\t$(TRAINING_BIN)/lstmtraining --debug_interval $(DEBUG_INTERVAL) --traineddata $(PROTO_MODEL) --old_traineddata start_{lang}.traineddata --continue_from start_model/{lang}.lstm --learning_rate $(LEARNING_RATE) --model_output checkpoints/{lang} --train_listfile {lang}.lstmf_train.list --eval_listfile {lang}.lstmf_test.list --max_iterations $(MAX_ITERATIONS) --target_error_rate $(TARGET_ERROR_RATE) 2>&1 | tee lstmtraining.log\n\n')
-        w.write(f'continue: $(PROTO_MODEL) $(LAST_CHECKPOINT) {lang}.lstmf_train.list {lang}.lstmf_test.list\n')
+        w.write(f'continue: $(PROTO_MODEL) $(LAST_CHECKPOINT) {lang}.lstmf_train.list {lang}.lstmf_test.list{lstmf_dep}\n')
         w.write(f'\t$(TRAINING_BIN)/lstmtraining --debug_interval $(DEBUG_INTERVAL) --traineddata $(PROTO_MODEL) --old_traineddata start_{lang}.traineddata --continue_from $(LAST_CHECKPOINT) --learning_rate $(LEARNING_RATE) --model_output checkpoints/{lang} --train_listfile {lang}.lstmf_train.list --eval_listfile {lang}.lstmf_test.list --max_iterations $(MAX_ITERATIONS) --target_error_rate $(TARGET_ERROR_RATE) 2>&1 | tee -a lstmtraining.log\n\n')
         w.write(f'{lang}.traineddata: $(LAST_CHECKPOINT) $(PROTO_MODEL)\n')
         w.write(f'\tfor i in checkpoints/{lang}_?.*checkpoint; do $(TRAINING_BIN)/lstmtraining --stop_training --continue_from "$$i" --traineddata $(PROTO_MODEL) --model_output $@; break; done\n\n')
@@ -375,4 +2619,93 @@ def main(lang, start_model, v3_model=None):
 
 
 if __name__ == '__main__':
-    main(*sys.argv[1:])
+    parser = argparse.ArgumentParser(
+        description='Render the LSTM training images and write the Makefile.')
+    parser.add_argument('-b', '--batch-size', type=int, default=1,
+        help='Render up to N lines of a font in one text2image call and '
+        'train them in one lstm.train call (needs PIL)')
+    parser.add_argument('--rebuild-manifest', action='store_true',
+        help='Rebuild the render manifest from the files on disk')
+    parser.add_argument('--full', action='store_true',
+        help='Sample all lines and rewrite the lists, instead of only '
+        'rendering the lines and fonts changed since the last run')
+    parser.add_argument('--migrate-layout', action='store_true',
+        help='Move the images of the old flat per-font directories into '
+        'the hash-prefix directories first')
+    parser.add_argument('--pack', action='store_true',
+        help='Move the rendered .lstmf files into tar shards in %s '
+        '(the Makefile unpacks them before training)' % LSTMF_SHARD_DIR)
+    parser.add_argument('--drop-images', action='store_true',
+        help='With --pack, also remove the .tif/.box files of the packed '
+        'images')
+    parser.add_argument('--unpack-shards', action='store_true',
+        help='Only write the missing .lstmf files of the lists from the '
+        'shards')
+    parser.add_argument('-r', '--renderer', default='text2image',
+        choices=('text2image', 'pil'),
+        help='Render the lines with text2image, or in-process with PIL for '
+        'the fonts in the fonts directory (needs PIL and fontTools)')
+    parser.add_argument('-s', '--scheduler', default='threads',
+        choices=('threads', 'asyncio'),
+        help='Run the training tools from a thread pool, or from asyncio '
+        'with fewer processes when the load is high or memory is low')
+    parser.add_argument('-j', '--jobs', type=int,
+        help='Maximum number of renders at once (default: 40%% of the CPUs '
+        'for threads, all CPUs for asyncio)')
+    parser.add_argument('-t', '--timeout', type=float,
+        default=PROCESS_TIMEOUT,
+        help='Kill a training tool after this many seconds (default: '
+        '%(default)s)')
+    parser.add_argument('--metrics', default=METRICS_FILE,
+        help='Append the time, retries, output sizes and failure class of '
+        'each rendered line to this JSON-lines file (default: %(default)s)')
+    parser.add_argument('--plan', action='store_true',
+        help='Only plan the render: print the sampled pairs of each font '
+        'and split, the cached fraction and the time estimated from the '
+        'metrics, and save the plan for the next run')
+    parser.add_argument('--queue', metavar='FILE',
+        help='Put the render tasks in a work queue in FILE for --worker '
+        'processes, and write the lists from their results. The working '
+        'directory must be shared with the workers')
+    parser.add_argument('--worker', metavar='FILE',
+        help='Only render the tasks of the work queue in FILE until its '
+        'coordinator finishes, in the shared working directory of the '
+        'coordinator')
+    parser.add_argument('--subset-fonts', action='store_true',
+        help='Render with text2image from subsets of the listed fonts '
+        'limited to the characters of the texts, cached in %s (needs '
+        'fontTools)' % FONT_SUBSET_DIR)
+    parser.add_argument('lang', help='chi_sim, chi_tra, chi_all, *_vert')
+    parser.add_argument('start_model', help='traineddata to start from')
+    parser.add_argument('v3_model', nargs='?',
+        help='v3 traineddata for the normproto')
+    args = parser.parse_args()
+    PROCESS_TIMEOUT = args.timeout
+    if args.worker:
+        queue = WorkQueue(args.worker)
+        renderer = None
+        if args.renderer == 'pil':
+            if fontTools is None or line_renderer is None:
+                print('PIL or fontTools not found, using text2image.')
+            else:
+                # the manifest is the coordinator's
+                renderer = PILRenderer(
+                    FontCoverage(sqlite3.connect(':memory:')), args.jobs)
+        metrics = RenderMetrics(args.metrics)
+        run_worker(queue, args.scheduler, args.jobs, renderer, metrics)
+        if renderer is not None:
+            renderer.close()
+        metrics.summary()
+        metrics.close()
+        queue.close()
+    elif args.unpack_shards:
+        manifest = RenderManifest()
+        unpack_lstmfs(manifest, ['%s.lstmf_%s.list' % (args.lang, name)
+                                 for name in ('train', 'test')])
+        manifest.close()
+    else:
+        main(args.lang, args.start_model, args.v3_model, args.batch_size,
+             args.rebuild_manifest, args.scheduler, args.jobs,
+             args.migrate_layout, args.pack, args.drop_images, args.full,
+             args.renderer, args.metrics, args.plan, args.queue,
+             args.subset_fonts)
@@ -6,9 +6,10 @@ import re
 import sys
 import string
 import random
-import textwrap
 import unicodedata
 
+from cjkwrap import CJKWrapper
+
 LEFT_PUNCTS = "\"'(（[{‘“〈《「『【〔"
 RIGHT_PUNCTS = "\"')）]}’”〉》」』】〕"
 MIDDLE_PUNCTS = "!&*,./:;?@\\_~·、。々！，：；？—…"
@@ -46,14 +47,8 @@ detokenize = lambda s: RE_WS_IN_FW.sub(r'\1', s)
 
 random.seed(12345)
 
-class CJKTextWrapper(textwrap.TextWrapper):
-    wordsep_simple_re = re.compile(r'(\s+|[%s]*[\u4e00-\u9FFF][%s]*|[¥$+-]*\d+(?:\.\d+)?(?:e[+-]\d+)?)' % (
-        re.escape(LEFT_PUNCTS), re.escape(RIGHT_PUNCTS + MIDDLE_PUNCTS.replace('¥', ''))
-    ))
-
-    def _split(self, text):
-        chunks = self.wordsep_simple_re.split(text)
-        return [c for c in chunks if c]
+WRAPPER = CJKWrapper(
+    LEFT_PUNCTS, RIGHT_PUNCTS + MIDDLE_PUNCTS.replace('¥', ''))
 
 def remove_dup_puncts(match):
     s = match.group(0)
@@ -148,8 +143,8 @@ if __name__ == '__main__':
         if len(long_ln) < max_length:
             lns = (long_ln,)
         else:
-            wrapper = CJKTextWrapper(width=round(random.triangular(30, max_length, max_length)))
-            lns = wrapper.wrap(long_ln)
+            lns = WRAPPER.wrap(long_ln, round(
+                random.triangular(30, max_length, max_length)))
         for ln in lns:
             if not ln:
                 continue
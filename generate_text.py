@@ -1,15 +1,25 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import os
 import re
 import sys
 import math
+import mmap
+import array
 import random
 import string
-import textwrap
+import struct
+import hashlib
+import argparse
+import operator
 import itertools
 import unicodedata
 import collections
+import collections.abc
+import multiprocessing
+
+from cjkwrap import CJKWrapper
 
 random.seed(12345)
 
@@ -36,15 +46,229 @@ ALL_PUNCTS = frozenset(LEFT_PUNCTS + RIGHT_PUNCTS + MIDDLE_PUNCTS)
 
 re_alphanum = re.compile('[A-Za-z0-9]')
 
+# character classes for TextGenerator.has_space
+CHAR_CLASSES = ('alphanum', 'fw', 'fw-p', 'left', 'right', 'stop', 'hw')
+SPACED_CLASSES = frozenset((
+    ('alphanum', 'alphanum'),
+    ('alphanum', 'fw'),
+    ('alphanum', 'left'),
+    ('alphanum', 'hw'),
+    ('fw', 'alphanum'),
+    ('fw', 'left'),
+    ('fw', 'hw'),
+    ('left', 'right'),
+    ('left', 'stop'),
+    ('left', 'hw'),
+    ('right', 'alphanum'),
+    ('right', 'fw'),
+    ('right', 'left'),
+    ('right', 'hw'),
+    ('stop', 'alphanum'),
+    ('stop', 'fw'),
+    ('stop', 'left'),
+    ('stop', 'stop'),
+    ('stop', 'hw'),
+    ('hw', 'alphanum'),
+    ('hw', 'fw'),
+    ('hw', 'left'),
+    ('hw', 'stop'),
+    ('hw', 'hw'),
+))
+# indexed by class1 * len(CHAR_CLASSES) + class2
+SPACE_MATRIX = tuple(
+    ' ' if (c1, c2) in SPACED_CLASSES else ''
+    for c1 in CHAR_CLASSES for c2 in CHAR_CLASSES)
+CLASS_MASK = 7
+# flags used by the legacy generate_text()
+CH_PUNCT = 8
+CH_WIDE = 16
+CH_LO = 32
+# CJK Unified Ideographs Extension B - H
+SUPP_RANGE = (0x20000, 0x323B0)
 
-class CJKTextWrapper(textwrap.TextWrapper):
-    wordsep_simple_re = re.compile(r'(\s+|[%s]*[\u4e00-\u9FFF][%s]*|[¥$+-]*\d+(?:\.\d+)?(?:e[+-]\d+)?)' % (
-        re.escape(LEFT_PUNCTS), re.escape(RIGHT_PUNCTS + MIDDLE_PUNCTS.replace('¥', ''))
-    ))
 
-    def _split(self, text):
-        chunks = self.wordsep_simple_re.split(text)
-        return [c for c in chunks if c]
+def char_info(ch):
+    category = unicodedata.category(ch)
+    wide = unicodedata.east_asian_width(ch) in 'FWA'
+    punct = ch in ALL_PUNCTS
+    if re_alphanum.match(ch) or category in ('Ll', 'Lu'):
+        ch_type = 'alphanum'
+    elif wide:
+        ch_type = 'fw-p' if punct else 'fw'
+    elif ch in LEFT_PUNCTS:
+        ch_type = 'left'
+    elif ch in RIGHT_PUNCTS:
+        ch_type = 'right'
+    elif ch in '!*,.:;?':
+        ch_type = 'stop'
+    else:
+        ch_type = 'hw'
+    return (CHAR_CLASSES.index(ch_type) | punct * CH_PUNCT |
+            wide * CH_WIDE | (category == 'Lo') * CH_LO)
+
+
+class CharInfoTable:
+    # char_info() precomputed for the BMP and the CJK supplementary planes
+    def __init__(self):
+        self.bmp = bytes(map(char_info, map(chr, range(0x10000))))
+        self.supp = bytes(map(char_info, map(chr, range(*SUPP_RANGE))))
+
+    def __getitem__(self, ch):
+        cp = ord(ch)
+        if cp < 0x10000:
+            return self.bmp[cp]
+        elif SUPP_RANGE[0] <= cp < SUPP_RANGE[1]:
+            return self.supp[cp - SUPP_RANGE[0]]
+        return char_info(ch)
+
+
+_char_info_table = None
+
+
+def get_char_info_table():
+    global _char_info_table
+    if _char_info_table is None:
+        _char_info_table = CharInfoTable()
+    return _char_info_table
+
+
+WRAPPER = CJKWrapper(
+    LEFT_PUNCTS, RIGHT_PUNCTS + MIDDLE_PUNCTS.replace('¥', ''))
+
+
+class WeightedSampler:
+    # Fenwick tree over the weights: O(log n) draws and removals, O(n) reset
+    def __init__(self, items, weights):
+        self.items = list(items)
+        self.weights = [float(x) for x in weights]
+        self.index = {item: i for i, item in enumerate(self.items)}
+        self.size = len(self.items)
+        self.top = 1 << (self.size.bit_length() - 1) if self.size else 0
+        self.reset()
+
+    def reset(self):
+        n = self.size
+        self.cur_weights = self.weights.copy()
+        tree = [0.0] + self.cur_weights
+        for i in range(1, n + 1):
+            j = i + (i & -i)
+            if j <= n:
+                tree[j] += tree[i]
+        self.tree = tree
+        self.total = math.fsum(self.cur_weights)
+        self.remaining = sum(1 for x in self.cur_weights if x > 0)
+
+    def __bool__(self):
+        return self.remaining > 0
+
+    def __len__(self):
+        return self.remaining
+
+    def __contains__(self, item):
+        idx = self.index.get(item)
+        return idx is not None and self.cur_weights[idx] > 0
+
+    def choice(self):
+        r = random.random() * self.total
+        tree = self.tree
+        n = self.size
+        pos = 0
+        step = self.top
+        while step:
+            nxt = pos + step
+            if nxt <= n and tree[nxt] <= r:
+                pos = nxt
+                r -= tree[nxt]
+            step >>= 1
+        # float rounding may land past the end or on a removed item
+        if pos >= n or not self.cur_weights[pos]:
+            pos = min(pos, n - 1)
+            while pos > 0 and not self.cur_weights[pos]:
+                pos -= 1
+            while pos < n - 1 and not self.cur_weights[pos]:
+                pos += 1
+        return self.items[pos]
+
+    def remove(self, item):
+        idx = self.index[item]
+        weight = self.cur_weights[idx]
+        if not weight:
+            return
+        self.cur_weights[idx] = 0.0
+        tree = self.tree
+        n = self.size
+        i = idx + 1
+        while i <= n:
+            tree[i] -= weight
+            i += i & -i
+        self.total -= weight
+        self.remaining -= 1
+
+
+class CoverageTracker:
+    # remaining uses per item, O(1) membership, decrement and random pick
+    def __init__(self, items, count=2):
+        self.counts = {}
+        self.items = []
+        self.pos = {}
+        self.total = 0
+        for item in items:
+            if item in self.counts:
+                self.counts[item] += count
+            else:
+                self.counts[item] = count
+                self.pos[item] = len(self.items)
+                self.items.append(item)
+            self.total += count
+
+    def __bool__(self):
+        return bool(self.items)
+
+    def __len__(self):
+        return self.total
+
+    def __contains__(self, item):
+        return item in self.counts
+
+    def __repr__(self):
+        return '%s(%d items, %d uses)' % (
+            type(self).__name__, len(self.items), self.total)
+
+    def use(self, item):
+        # returns True if the item is used up
+        count = self.counts.get(item)
+        if count is None:
+            return False
+        self.total -= 1
+        if count > 1:
+            self.counts[item] = count - 1
+            return False
+        del self.counts[item]
+        idx = self.pos.pop(item)
+        last = self.items.pop()
+        if last != item:
+            self.items[idx] = last
+            self.pos[last] = idx
+        return True
+
+    def use_all(self, word):
+        used = 0
+        for ch in dict.fromkeys(word):
+            if ch in self.counts:
+                self.use(ch)
+                used += 1
+        return used
+
+    def choice(self):
+        return self.items[random.randrange(len(self.items))]
+
+
+def index_chars(words):
+    index = collections.defaultdict(list)
+    for word in words:
+        for ch in dict.fromkeys(word):
+            index[ch].append(word)
+    return index
 
 
 def load_wordlist(bigram_freq_file, char_list):
@@ -101,45 +325,232 @@ def load_simplewordlist(filename):
     return words
 
 
+def average_freqs(tables):
+    # mean of each key over the tables that have it, in the order of first
+    # appearance; one pass of builtins for each table
+    keys = list(dict.fromkeys(itertools.chain.from_iterable(tables)))
+    totals = [0.0] * len(keys)
+    counts = [0] * len(keys)
+    for table in tables:
+        totals = list(map(operator.add, totals,
+            map(table.get, keys, itertools.repeat(0.0))))
+        counts = list(map(operator.add, counts, map(table.__contains__, keys)))
+    return dict(zip(keys, map(operator.truediv, totals, counts)))
+
+
+def merge_wordlists(tables):
+    if len(tables) == 1:
+        return tables[0]
+    freq1 = average_freqs([x[0] for x in tables])
+    rows = collections.defaultdict(list)
+    for tfreq1, tfreq2 in tables:
+        for word1, wl2 in tfreq2.items():
+            row = dict(wl2)
+            if len(row) < len(wl2):
+                # '' is repeated for each word2 out of the charset
+                row = dict.fromkeys(row, 0)
+                for word2, freq in wl2:
+                    row[word2] += freq
+            rows[word1].append(row)
+    freq2 = {}
+    for word1, row_tables in rows.items():
+        if len(row_tables) == 1:
+            freq2[word1] = list(row_tables[0].items())
+        else:
+            freq2[word1] = list(average_freqs(row_tables).items())
+    return freq1, freq2
+
+
+CACHE_MAGIC = b'TGBIGRM2'
+# magic, key, unigrams, bigram rows, bigram entries, word blob size
+CACHE_HEADER = struct.Struct('<8s32sQQQQ')
+
+
+def _pad8(n):
+    return -n % 8
+
+
+class BigramTable(collections.abc.Mapping):
+    # word1 -> (wlist2, cum_weights) like TextGenerator.bigrams, read from a
+    # memory-mapped cache file; rows are decoded on first access
+    def __init__(self, filename, key=None):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        buf = memoryview(self.mmap)
+        magic, file_key, n1, n2, n_entries, blob_len = \
+            CACHE_HEADER.unpack_from(buf)
+        if magic != CACHE_MAGIC or (key is not None and file_key != key):
+            raise ValueError('stale bigram cache: %s' % filename)
+        self.key = file_key
+        sections = (
+            ('chars1', n1 * 4), ('freqs1', n1 * 8), ('heads', n2 * 4),
+            ('entry_offsets', (n2 + 1) * 8), ('blob_offsets', (n2 + 1) * 8),
+            ('cum_weights', n_entries * 8), ('blob', blob_len)
+        )
+        views = {}
+        offset = CACHE_HEADER.size
+        for name, size in sections:
+            views[name] = buf[offset:offset+size]
+            offset += size + _pad8(size)
+        if offset - _pad8(blob_len) > len(buf):
+            raise ValueError('truncated bigram cache: %s' % filename)
+        self.chars1 = bytes(views['chars1']).decode('utf-32-le')
+        self.freqs1 = views['freqs1'].cast('d')
+        self.index = {ch: i for i, ch in enumerate(
+            bytes(views['heads']).decode('utf-32-le'))}
+        self.entry_offsets = views['entry_offsets'].cast('Q')
+        self.blob_offsets = views['blob_offsets'].cast('Q')
+        self.cum_weights = views['cum_weights'].cast('d')
+        self.blob = views['blob']
+        self.rows = {}
+
+    def __reduce__(self):
+        return (type(self), (self.filename, self.key))
+
+    def unigrams(self):
+        return dict(zip(self.chars1, self.freqs1.tolist()))
+
+    def __getitem__(self, word1):
+        row = self.rows.get(word1)
+        if row is not None:
+            return row
+        idx = self.index[word1]
+        wlist2 = bytes(self.blob[
+            self.blob_offsets[idx]:self.blob_offsets[idx+1]
+        ]).decode('utf-8').split('\0')
+        row = self.rows[word1] = (wlist2, self.cum_weights[
+            self.entry_offsets[idx]:self.entry_offsets[idx+1]])
+        return row
+
+    def __contains__(self, word1):
+        return word1 in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+
+def bigram_cache_key(bigram_freq_files, char_list):
+    h = hashlib.blake2b(CACHE_MAGIC + sys.byteorder.encode('ascii'),
+                        digest_size=32)
+    for filename in bigram_freq_files:
+        st = os.stat(filename)
+        h.update(('%s\n%d\n%d\n' % (
+            os.path.basename(filename), st.st_size, st.st_mtime_ns
+        )).encode('utf-8'))
+    h.update(''.join(sorted(char_list)).encode('utf-8'))
+    return h.digest()
+
+
+def compile_bigram_cache(filename, key, freq1, freq2):
+    chars1 = ''.join(freq1)
+    heads = ''.join(freq2)
+    if len(chars1) != len(freq1) or len(heads) != len(freq2):
+        raise ValueError('only single character keys can be cached')
+    entry_offsets = array.array('Q', [0])
+    blob_offsets = array.array('Q', [0])
+    cum_weights = array.array('d')
+    blob = bytearray()
+    for wl2 in freq2.values():
+        wlist2, weights2 = zip(*wl2)
+        cum_weights.extend(itertools.accumulate(weights2))
+        blob.extend('\0'.join(wlist2).encode('utf-8'))
+        entry_offsets.append(len(cum_weights))
+        blob_offsets.append(len(blob))
+    sections = (
+        chars1.encode('utf-32-le'),
+        array.array('d', freq1.values()).tobytes(),
+        heads.encode('utf-32-le'),
+        entry_offsets.tobytes(),
+        blob_offsets.tobytes(),
+        cum_weights.tobytes(),
+        bytes(blob)
+    )
+    tmpname = filename + '.tmp'
+    with open(tmpname, 'wb') as f:
+        f.write(CACHE_HEADER.pack(
+            CACHE_MAGIC, key, len(chars1), len(heads),
+            len(cum_weights), len(blob)))
+        for data in sections:
+            f.write(data)
+            f.write(bytes(_pad8(len(data))))
+    os.replace(tmpname, filename)
+
+
+def load_wordlist_cached(bigram_freq_files, char_list, cache_file=None):
+    if cache_file is None:
+        cache_file = os.path.join(
+            os.path.dirname(bigram_freq_files[0]),
+            '.'.join(os.path.splitext(os.path.basename(x))[0]
+                     for x in bigram_freq_files) + '.cache')
+    key = bigram_cache_key(bigram_freq_files, char_list)
+    try:
+        table = BigramTable(cache_file, key)
+    except (OSError, ValueError, struct.error):
+        freq1, freq2 = merge_wordlists([
+            load_wordlist(x, char_list) for x in bigram_freq_files])
+        compile_bigram_cache(cache_file, key, freq1, freq2)
+        table = BigramTable(cache_file, key)
+    return table.unigrams(), table
+
+
 class TextGenerator:
-    def __init__(self, freq1, freq2, add_words, eng_words):
+    def __init__(self, freq1, freq2, add_words, eng_words, shard=None):
         self.chars = []
         self.char_freq = []
         for word, freq in freq1.items():
             self.chars.append(word)
             self.char_freq.append(freq)
         self.chars_set = frozenset(self.chars)
-        self.char_cum_weights = tuple(itertools.accumulate(self.char_freq))
-        self.bigrams = freq2
-        for word1, wl2 in freq2.items():
-            wlist2, weights2 = zip(*wl2)
-            self.bigrams[word1] = (wlist2, tuple(itertools.accumulate(weights2)))
+        self.char_info = get_char_info_table()
+        if isinstance(freq2, BigramTable):
+            # already cumulative
+            self.bigrams = freq2
+        else:
+            self.bigrams = {}
+            for word1, wl2 in freq2.items():
+                wlist2, weights2 = zip(*wl2)
+                self.bigrams[word1] = (
+                    wlist2, tuple(itertools.accumulate(weights2)))
 
         # pinyin, bpmf
-        self.add_words = list(set(add_words) |
+        # sorted, so that the output only depends on the random seed
+        self.add_words = sorted(set(add_words) |
             set(x.upper() for x in eng_words))
-        self.eng_words = list(set(eng_words) |
+        self.eng_words = sorted(set(eng_words) |
             set(x.lower() for x in eng_words) |
             set(x.upper() for x in eng_words) |
             set(x.title() for x in eng_words))
 
-        self.cur_chars = self.chars.copy()
-        self.cur_char_freq = self.char_freq.copy()
-        self.cur_char_cum_weights = self.char_cum_weights
+        self.add_index = index_chars(self.add_words)
+        self.eng_index = index_chars(self.eng_words)
+
+        self.char_sampler = WeightedSampler(self.chars, self.char_freq)
 
-        self.unused_chars = list(self.chars) * 2
-        self.unused_eng = list(string.ascii_letters) * 2
-        self.unused_add = sorted(set(itertools.chain(*add_words))) * 2
-        self.unused_digit = list(string.digits + ''.join(DIGIT_PUNCTS)) * 2
-        self.unused_punc = sorted(ALL_PUNCTS) * 2
+        # shard = (index, count): only cover every count-th item
+        index, count = shard or (0, 1)
+        self.unused_chars = CoverageTracker(self.chars[index::count])
+        self.unused_eng = CoverageTracker(string.ascii_letters[index::count])
+        self.unused_add = CoverageTracker(
+            sorted(set(itertools.chain(*add_words)))[index::count])
+        self.unused_digit = CoverageTracker(
+            (string.digits + ''.join(DIGIT_PUNCTS))[index::count])
+        self.unused_punc = CoverageTracker(sorted(ALL_PUNCTS)[index::count])
 
         self.last_char = None
         self.status = 0
         self.left_punc = None
 
-    def get_eng_words(self):
+    def get_eng_words(self, need=None):
         words = []
-        for word in random.choices(self.eng_words, k=random.randint(1, 3)):
+        chosen = random.choices(self.eng_words, k=random.randint(1, 3))
+        if need is not None:
+            chosen[random.randrange(len(chosen))] = random.choice(
+                self.eng_index.get(need) or (need,))
+        for word in chosen:
             # punc = random.randint(0, ws_weight)
             # ws_weight = 50
             # if not word[-1].isalpha():
@@ -174,73 +585,106 @@ class TextGenerator:
         result = ' '.join(words).replace('_ ', '_').replace('@ ', '@')
         return result
 
-    def get_add_words(self):
-        result = ' '.join(
-            random.choices(self.add_words, k=random.randint(1, 2)))
+    def get_add_words(self, need=None):
+        chosen = random.choices(self.add_words, k=random.randint(1, 2))
+        if need is not None:
+            chosen[random.randrange(len(chosen))] = random.choice(
+                self.add_index.get(need) or (need,))
+        result = ' '.join(chosen)
         if random.randint(0, 1) == 0:
             result = '(%s)' % result
         return result
 
-    def get_digits(self):
-        digit_num = random.randint(1, 3)
+    def get_digits(self, need=None):
+        if need is None or need in string.digits:
+            digit_num = random.randint(1, 3)
+        elif need in DIGIT_PUNCTS[1]:
+            digit_num = random.randint(2, 3)
+        else:
+            digit_num = 1
         if digit_num == 1:
-            digit_type = random.randint(0, 2)
+            if need is None or need in string.digits:
+                digit_type = random.randint(0, 2)
+            elif need in DIGIT_PUNCTS[0]:
+                digit_type = 1
+            else:
+                digit_type = 2
             result = '%.5g' % math.exp(random.uniform(0, 16))
             if digit_type == 1:
                 result = random.choice(DIGIT_PUNCTS[0]) + result
             elif digit_type == 2:
                 result += random.choice(DIGIT_PUNCTS[2])
         else:
-            result = ''
-            for i in range(digit_num):
-                if i > 0:
-                    result += ' %s ' % random.choice(DIGIT_PUNCTS[1])
-                result += '%.5g' % math.exp(random.uniform(0, 16))
-        return result
+            ops = [random.choice(DIGIT_PUNCTS[1]) for i in range(digit_num - 1)]
+            if need is not None and need in DIGIT_PUNCTS[1]:
+                ops[random.randrange(len(ops))] = need
+            result = '%.5g' % math.exp(random.uniform(0, 16))
+            for op in ops:
+                result += ' %s %.5g' % (op, math.exp(random.uniform(0, 16)))
+        if need is None or need in result:
+            return result
+        elif need in string.digits:
+            # overwrite a digit that is not leading
+            positions = [i for i, ch in enumerate(result)
+                         if i and ch in string.digits]
+            if not positions:
+                return result + need
+            i = random.choice(positions)
+            return result[:i] + need + result[i+1:]
+        elif need in DIGIT_PUNCTS[0]:
+            return need + result[1:]
+        return result[:-1] + need
 
-    def get_char(self):
+    def get_char(self, need=None):
         get_single = True
-        if self.last_char in self.bigrams:
+        if need is not None:
+            get_single = False
+            ch = need
+        elif self.last_char in self.bigrams:
             get_single = False
             wlist2, cw2 = self.bigrams[self.last_char]
             ch = random.choices(wlist2, cum_weights=cw2)[0]
             if not ch:
                 get_single = True
         if get_single:
-            if not self.cur_chars:
-                self.cur_chars = self.chars.copy()
-                self.cur_char_freq = self.char_freq.copy()
-                self.cur_char_cum_weights = self.char_cum_weights
-            ch = random.choices(
-                self.cur_chars, cum_weights=self.cur_char_cum_weights)[0]
-
-        if ch in self.unused_chars:
-            idx = self.unused_chars.index(ch)
-            del self.unused_chars[idx]
-            if ch not in self.unused_chars:
-                idx = self.cur_chars.index(ch)
-                del self.cur_chars[idx]
-                del self.cur_char_freq[idx]
-                self.cur_char_cum_weights = tuple(
-                    itertools.accumulate(self.cur_char_freq))
+            if not self.char_sampler:
+                self.char_sampler.reset()
+            ch = self.char_sampler.choice()
+
+        if self.unused_chars.use(ch):
+            self.char_sampler.remove(ch)
         return ch
 
-    def get_punc(self, punc_type=None):
+    def get_punc(self, punc_type=None, need=None):
+        if need is not None:
+            if need in MIDDLE_PUNCTS:
+                punc_type = 'middle'
+            elif self.left_punc is not None:
+                # close the open pair first
+                punc_type = 'right'
+            else:
+                punc_type = 'left'
+                if need in LEFT_PUNCTS:
+                    self.left_punc = LEFT_PUNCTS.index(need)
+                else:
+                    self.left_punc = RIGHT_PUNCTS.index(need)
         if punc_type is None:
             if self.left_punc is None:
                 punc_type = random.choice(('left', 'middle'))
             else:
                 punc_type = 'right'
         if punc_type == 'left':
-            self.left_punc = random.randrange(len(LEFT_PUNCTS))
+            if need is None:
+                self.left_punc = random.randrange(len(LEFT_PUNCTS))
             word = LEFT_PUNCTS[self.left_punc]
         elif punc_type == 'middle':
-            word = random.choice(MIDDLE_PUNCTS)
+            word = need or random.choice(MIDDLE_PUNCTS)
             if word in PUNCT_PATTERN_L and random.randint(0, 1):
                 word += random.choice(PUNCT_PATTERN_L[word])
             elif word == '…':
                 word += '…'
-            elif word == ',' and self.last_char in self.chars_set:
+            elif (word == ',' and need is None and
+                  self.last_char in self.chars_set):
                 word = '，'
         # elif punc_type == 'right':
         else:
@@ -288,8 +732,7 @@ class TextGenerator:
                 elif word == ',':
                     word = '，'
                 self.status = 0
-                if word in self.unused_punc:
-                    del self.unused_punc[self.unused_punc.index(word)]
+                self.unused_punc.use(word)
                 if word == '…':
                     word += '…'
             else:
@@ -297,9 +740,7 @@ class TextGenerator:
         elif next_type in ('left', 'middle', 'right'):
             word = self.get_punc(next_type)
             self.status = 0
-            used_new = set(word).intersection(self.unused_punc)
-            for ch in used_new:
-                del self.unused_punc[self.unused_punc.index(ch)]
+            self.unused_punc.use_all(word)
         # elif next_type in ('eng', 'add', 'digit'):
         else:
             if next_type == 'eng':
@@ -315,87 +756,45 @@ class TextGenerator:
                 fn = self.get_digits
                 self.status = 4
             if unused:
-                while True:
-                    word = fn()
-                    used_new = set(word).intersection(unused)
-                    if used_new:
-                        break
-                for ch in used_new:
-                    del unused[unused.index(ch)]
+                word = fn(unused.choice())
+                unused.use_all(word)
             else:
                 word = fn()
-            used_new = set(word).intersection(self.unused_punc)
-            for ch in used_new:
-                del self.unused_punc[self.unused_punc.index(ch)]
+            self.unused_punc.use_all(word)
         return word
 
     def has_space(self, word):
         if not self.last_char or not word:
             return ''
-        ch_types = ['fw', 'fw']
-        for i, ch in enumerate((self.last_char, word[0])):
-            if re_alphanum.match(ch) or unicodedata.category(ch) in ('Ll', 'Lu'):
-                ch_types[i] = 'alphanum'
-            elif unicodedata.east_asian_width(ch) in 'FWA':
-                if ch in ALL_PUNCTS:
-                    ch_types[i] = 'fw-p'
-                else:
-                    ch_types[i] = 'fw'
-            elif ch in LEFT_PUNCTS:
-                ch_types[i] = 'left'
-            elif ch in RIGHT_PUNCTS:
-                ch_types[i] = 'right'
-            elif ch in '!*,.:;?':
-                ch_types[i] = 'stop'
-            else:
-                ch_types[i] = 'hw'
-        #print(self.last_char, word[0], ch_types)
-        if tuple(ch_types) in (
-            ('alphanum', 'alphanum'),
-            ('alphanum', 'fw'),
-            ('alphanum', 'left'),
-            ('alphanum', 'hw'),
-            ('fw', 'alphanum'),
-            ('fw', 'left'),
-            ('fw', 'hw'),
-            ('left', 'right'),
-            ('left', 'stop'),
-            ('left', 'hw'),
-            ('right', 'alphanum'),
-            ('right', 'fw'),
-            ('right', 'left'),
-            ('right', 'hw'),
-            ('stop', 'alphanum'),
-            ('stop', 'fw'),
-            ('stop', 'left'),
-            ('stop', 'stop'),
-            ('stop', 'hw'),
-            ('hw', 'alphanum'),
-            ('hw', 'fw'),
-            ('hw', 'left'),
-            ('hw', 'stop'),
-            ('hw', 'hw'),
-        ):
-            return ' '
-        return ''
+        char_info = self.char_info
+        return SPACE_MATRIX[
+            (char_info[self.last_char] & CLASS_MASK) * len(CHAR_CLASSES) +
+            (char_info[word[0]] & CLASS_MASK)]
 
-    def generate_text(self, total_length=250000):
-        length = 0
-        result = []
-        unused_list = (
+    def unused_list(self):
+        return (
             (self.unused_chars, self.get_char),
             (self.unused_eng, self.get_eng_words),
             (self.unused_add, self.get_add_words),
             (self.unused_digit, self.get_digits),
             (self.unused_punc, self.get_punc)
         )
-        while length < total_length - sum(map(len, unused_list)) * 3:
+
+    def fill_words(self, get_limit):
+        while self.length < get_limit():
             word = self.get_next_word()
             if word:
-                result.append(self.has_space(word) + word)
-                length += len(result[-1])
+                result = self.has_space(word) + word
+                self.length += len(result)
                 self.last_char = word[-1]
-        # print(unused_list)
+                yield result
+
+    def cover_words(self):
+        unused_list = self.unused_list()
+        # only draw the characters that are still to be covered
+        for ch in self.chars:
+            if ch not in self.unused_chars:
+                self.char_sampler.remove(ch)
         while self.unused_chars:
             self.status = 5
             self.last_char = None
@@ -403,50 +802,85 @@ class TextGenerator:
                 word = self.get_next_word()
                 if not word:
                     break
-                result.append(self.has_space(word) + word)
-                length += len(result[-1])
+                result = self.has_space(word) + word
+                self.length += len(result)
+                yield result
         while any(x[0] for x in unused_list):
             self.status = 0
             for i in range(random.randrange(1, 10)):
                 word = self.get_next_word()
                 if not word:
                     continue
-                result.append(self.has_space(word) + word)
-                length += len(result[-1])
+                result = self.has_space(word) + word
+                self.length += len(result)
                 self.last_char = word[-1]
+                yield result
             unused, fn = random.choice([x for x in unused_list if x[0]])
-            while True:
-                word = fn()
-                used_new = set(word).intersection(unused)
-                if used_new:
-                    break
-            for ch in used_new:
-                del unused[unused.index(ch)]
-            result.append(self.has_space(word) + word)
-            length += len(result[-1])
+            word = fn(need=unused.choice())
+            unused.use_all(word)
+            result = self.has_space(word) + word
+            self.length += len(result)
             self.last_char = word[-1]
-        while length < total_length:
-            word = self.get_next_word()
-            if word:
-                result.append(self.has_space(word) + word)
-                length += len(result[-1])
-                self.last_char = word[-1]
-        tw = CJKTextWrapper(width=40)
-        return tw.fill(''.join(result))
+            yield result
+
+    def iter_words(self, total_length=250000):
+        self.length = 0
+        unused_list = self.unused_list()
+        yield from self.fill_words(lambda: (
+            total_length - sum(len(x[0]) for x in unused_list) * 3))
+        yield from self.cover_words()
+        yield from self.fill_words(lambda: total_length)
+
+    def iter_lines(self, total_length=250000, width=40):
+        return WRAPPER.wrap_iter(self.iter_words(total_length), width)
+
+    def generate_text(self, total_length=250000):
+        return '\n'.join(self.iter_lines(total_length))
+
+
+def shard_seed(seed, index):
+    return int.from_bytes(hashlib.blake2b(
+        ('%s\n%d' % (seed, index)).encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+_shard_tables = None
+
+
+def _init_shard_worker(*tables):
+    global _shard_tables
+    _shard_tables = tables
+
+
+def _generate_shard(args):
+    seed, index, count, total_length = args
+    random.seed(shard_seed(seed, index))
+    tg = TextGenerator(*_shard_tables, shard=(index, count))
+    return tg.generate_text(total_length)
+
+
+def generate_text_sharded(freq1, freq2, add_words, eng_words,
+                          total_length=250000, shards=4, seed=12345, jobs=None):
+    # the output only depends on the seed and the number of shards
+    tasks = []
+    for i in range(shards):
+        length = total_length // shards + (i < total_length % shards)
+        tasks.append((seed, i, shards, length))
+    with multiprocessing.Pool(
+        min(jobs or os.cpu_count(), shards), _init_shard_worker,
+        (freq1, freq2, add_words, eng_words)
+    ) as pool:
+        yield from pool.imap(_generate_shard, tasks)
 
 
 def generate_text(freq1, freq2, additional_list, eng_words, total_length=250000):
     length = 0
     wlist1 = [x[0] for x in freq1]
-    wlist1_orig = wlist1.copy()
-    weights1 = [x[1] for x in freq1]
-    weights1_orig = weights1.copy()
-    cum_weights1 = tuple(itertools.accumulate(weights1))
-    cum_weights1_orig = cum_weights1
+    sampler1 = WeightedSampler(wlist1, [x[1] for x in freq1])
     unused = collections.Counter({x: 2 for x in wlist1})
-    unused_alphas = sorted(
+    unused_alphas = CoverageTracker(sorted(
         set(string.ascii_letters).union(set(itertools.chain(*additional_list)))
-    ) * 2
+    ))
+    char_info = get_char_info_table()
     f2weights = {}
     for word1, wl2 in freq2.items():
         wlist2, weights2 = zip(*wl2)
@@ -472,7 +906,6 @@ def generate_text(freq1, freq2, additional_list, eng_words, total_length=250000)
         return result
 
     def get_word(last_word, word):
-        nonlocal unused_alphas
         if not word:
             return None
         elif word == '…' and last_word[-1] != '…':
@@ -486,11 +919,8 @@ def generate_text(freq1, freq2, additional_list, eng_words, total_length=250000)
             if unused_alphas:
                 while True:
                     result = get_eng_words()
-                    used_new = set(result).intersection(unused_alphas)
-                    if used_new:
+                    if unused_alphas.use_all(result):
                         break
-                for ch in used_new:
-                    del unused_alphas[unused_alphas.index(ch)]
             else:
                 result = get_eng_words()
         elif word == '\uf002':
@@ -511,15 +941,15 @@ def generate_text(freq1, freq2, additional_list, eng_words, total_length=250000)
             result = word
         ch1 = last_word[-1]
         ch2 = result[0]
-        c1_ispunct = (ch1 in ALL_PUNCTS)
-        c2_ispunct = (ch2 in ALL_PUNCTS)
-        w1 = unicodedata.east_asian_width(ch1)
-        w2 = unicodedata.east_asian_width(ch2)
-        cat1 = unicodedata.category(ch1)
-        cat2 = unicodedata.category(ch2)
-        if cat1 == 'Lo' and cat2 == 'Lo':
+        info1 = char_info[ch1]
+        info2 = char_info[ch2]
+        c1_ispunct = info1 & CH_PUNCT
+        c2_ispunct = info2 & CH_PUNCT
+        w1_wide = info1 & CH_WIDE
+        w2_wide = info2 & CH_WIDE
+        if info1 & info2 & CH_LO:
             return result
-        elif cat1 == 'Lo' and ch2 == ',':
+        elif info1 & CH_LO and ch2 == ',':
             return '，'
         elif c1_ispunct and c2_ispunct:
             if (ch1 == ch2 or
@@ -532,24 +962,22 @@ def generate_text(freq1, freq2, additional_list, eng_words, total_length=250000)
             return result
         elif (
             (ch1 in '\uf001\uf002' and ch2 in '\uf001\uf002') or
-            (ch1 in '\uf001\uf002' and w2 in 'FWA' and not c2_ispunct) or
+            (ch1 in '\uf001\uf002' and w2_wide and not c2_ispunct) or
             (c1_ispunct and ch1 not in LEFT_PUNCTS
-             and not c2_ispunct and w1 not in 'FWA') or
-            (not c1_ispunct and w1 in 'FWA' and
-             not c2_ispunct and w2 not in 'FWA') or
-            (w1 not in 'FWA' and not c1_ispunct and w2 in 'FWA') or
-            (w1 in 'FWA' and c2_ispunct and w2 not in 'FWA' and ch2 not in ',.:;!?"\')]}')):
+             and not c2_ispunct and not w1_wide) or
+            (not c1_ispunct and w1_wide and
+             not c2_ispunct and not w2_wide) or
+            (not w1_wide and not c1_ispunct and w2_wide) or
+            (w1_wide and c2_ispunct and not w2_wide and ch2 not in ',.:;!?"\')]}')):
             result = ' ' + result
         return result
 
     result = []
     last_ch = '啊'
     while length < total_length - len(unused) * 3:
-        if not wlist1:
-            wlist1 = wlist1_orig.copy()
-            weights1 = weights1_orig.copy()
-            cum_weights1 = cum_weights1_orig
-        ch = random.choices(wlist1, cum_weights=cum_weights1)[0]
+        if not sampler1:
+            sampler1.reset()
+        ch = sampler1.choice()
         if unused and ch not in unused:
             continue
         word = get_word(last_ch, ch)
@@ -558,10 +986,7 @@ def generate_text(freq1, freq2, additional_list, eng_words, total_length=250000)
         result.append(word)
         unused[ch] -= 1
         if unused[ch] <= 0:
-            idx = wlist1.index(ch)
-            del wlist1[idx]
-            del weights1[idx]
-            cum_weights1 = tuple(itertools.accumulate(weights1))
+            sampler1.remove(ch)
             del unused[ch]
         last_ch = word
         length += len(word)
@@ -578,24 +1003,18 @@ def generate_text(freq1, freq2, additional_list, eng_words, total_length=250000)
             if ch in unused:
                 unused[ch] -= 1
                 if unused[ch] <= 0:
-                    idx = wlist1.index(ch)
-                    del wlist1[idx]
-                    del weights1[idx]
-                    cum_weights1 = tuple(itertools.accumulate(weights1))
+                    sampler1.remove(ch)
                     del unused[ch]
             last_ch = ch
             length += len(word)
     while unused_alphas:
         while True:
-            result = get_eng_words()
-            used_new = set(result).intersection(unused_alphas)
-            if used_new:
+            word = get_eng_words()
+            if unused_alphas.use_all(word):
                 break
-        for ch in used_new:
-            del unused_alphas[unused_alphas.index(ch)]
         result.append(' ' + word)
     while unused:
-        ch = random.choices(wlist1, cum_weights=cum_weights1)[0]
+        ch = sampler1.choice()
         if ch not in unused:
             continue
         word = get_word(last_ch, ch)
@@ -604,10 +1023,7 @@ def generate_text(freq1, freq2, additional_list, eng_words, total_length=250000)
         result.append(word)
         unused[ch] -= 1
         if unused[ch] <= 0:
-            idx = wlist1.index(ch)
-            del wlist1[idx]
-            del weights1[idx]
-            cum_weights1 = tuple(itertools.accumulate(weights1))
+            sampler1.remove(ch)
             del unused[ch]
         last_ch = ch
         length += len(word)
@@ -623,52 +1039,69 @@ def generate_text(freq1, freq2, additional_list, eng_words, total_length=250000)
         if ch in unused:
             unused[ch] -= 1
             if unused[ch] <= 0:
-                idx = wlist1.index(ch)
-                del wlist1[idx]
-                del weights1[idx]
-                cum_weights1 = tuple(itertools.accumulate(weights1))
+                sampler1.remove(ch)
                 del unused[ch]
         last_ch = ch
         length += len(word)
-    tw = CJKTextWrapper(width=40)
-    return tw.fill(''.join(result))
+    return WRAPPER.fill(''.join(result), 40)
 
 
 if __name__ == '__main__':
-    if len(sys.argv) < 2 or sys.argv[1] == 'zhs':
+    parser = argparse.ArgumentParser(
+        description='Generate synthetic training text.')
+    parser.add_argument('-l', '--length', type=int, default=250000,
+        help='Length of generated text in characters')
+    parser.add_argument('-s', '--stream', action='store_true',
+        help='Print wrapped lines as they are generated')
+    parser.add_argument('-n', '--shards', type=int, default=1,
+        help='Generate in N independent shards in parallel')
+    parser.add_argument('-j', '--jobs', type=int,
+        help='Number of worker processes for sharded generation')
+    parser.add_argument('--seed', type=int, default=12345,
+        help='Random seed')
+    parser.add_argument('--no-cache', action='store_true',
+        help='Do not use or write the compiled bigram cache')
+    parser.add_argument('lang', nargs='?', default='zhs',
+        help='zhs, zht, or all')
+    args = parser.parse_args()
+
+    if args.lang == 'zhs':
         char_list = set(load_simplewordlist('wordlist/zhs_chars_7000.txt'))
         char_list.add('〇')
-        freq1, freq2 = load_wordlist('wordlist/bigramfreq_zhs.txt', char_list)
+        bigram_files = ['wordlist/bigramfreq_zhs.txt']
         #additional_list = load_simplewordlist('wordlist/pinyin.txt')
-    elif sys.argv[1] == 'zht':
+    elif args.lang == 'zht':
         char_list = set(load_simplewordlist('wordlist/zht_chars_7000.txt'))
         char_list.add('〇')
-        freq1, freq2 = load_wordlist('wordlist/bigramfreq_zht.txt', char_list)
+        bigram_files = ['wordlist/bigramfreq_zht.txt']
         # disable bopomofo and pinyin
         #additional_list = load_simplewordlist('wordlist/bopomofo.txt')
         #additional_list = load_simplewordlist('wordlist/pinyin.txt')
     else:
         char_list = set(load_simplewordlist('wordlist/zh_all_chars.txt'))
         char_list.add('〇')
-        freq1, freq2 = load_wordlist('wordlist/bigramfreq_zhs.txt', char_list)
-        tfreq1, tfreq2 = load_wordlist('wordlist/bigramfreq_zht.txt', char_list)
-        for word, freq in tfreq1.items():
-            if word in freq1:
-                freq1[word] = (freq1[word] + freq) / 2
-            else:
-                freq1[word] = freq
-        for word1, tfreqs in tfreq2.items():
-            freqs = dict(freq2.get(word1, ()))
-            for word2, freq in tfreqs:
-                if word2 in freqs:
-                    freqs[word2] = (freqs[word2] + freq) / 2
-                else:
-                    freqs[word2] = freq
-            freq2[word1] = list(freqs.items())
+        bigram_files = [
+            'wordlist/bigramfreq_zhs.txt', 'wordlist/bigramfreq_zht.txt']
+    if args.no_cache:
+        freq1, freq2 = merge_wordlists([
+            load_wordlist(x, char_list) for x in bigram_files])
+    else:
+        freq1, freq2 = load_wordlist_cached(bigram_files, char_list)
     additional_list = []
     eng_words = load_simplewordlist('wordlist/google-10000-english.txt')
-    tg = TextGenerator(freq1, freq2, additional_list, eng_words)
-    text = tg.generate_text(250000)
-    print(text)
+    if args.shards > 1:
+        for text in generate_text_sharded(
+            freq1, freq2, additional_list, eng_words, args.length,
+            args.shards, args.seed, args.jobs
+        ):
+            print(text)
+    else:
+        random.seed(args.seed)
+        tg = TextGenerator(freq1, freq2, additional_list, eng_words)
+        if args.stream:
+            for line in tg.iter_lines(args.length):
+                print(line)
+        else:
+            print(tg.generate_text(args.length))
     with open('langdata/eng/eng.training_text', 'r', encoding='utf-8') as f:
         print(f.read(), end='')
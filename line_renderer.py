@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+# Renders a text line to the .tif/.box files of text2image with PIL, to be
+# run in worker processes of configure_lstm.py.
+
+import math
+import functools
+import unicodedata
+
+from PIL import Image, ImageDraw, ImageFont
+
+# text2image --ptsize
+PT_SIZE = 12
+# each exposure level moves the black threshold of the grey image
+EXPOSURE_STEP = 24
+
+
+@functools.lru_cache(maxsize=None)
+def load_font(font_file, font_index, size):
+    # once per worker
+    return ImageFont.truetype(font_file, size, index=font_index)
+
+
+def layout_horizontal(text, font, xsize, ysize, margin):
+    ascent, descent = font.getmetrics()
+    width = math.ceil(font.getlength(text)) + margin * 2
+    if width > xsize or ascent + descent + margin * 2 > ysize:
+        return None, None
+    im = Image.new('L', (width, ysize), 255)
+    draw = ImageDraw.Draw(im)
+    top = (ysize - ascent - descent) // 2
+    bottom = top + ascent + descent
+    draw.text((margin, top), text, font=font, fill=0)
+    boxes = []
+    right = margin
+    prev = ''
+    for ch in text:
+        # a running advance, with the kerning of each adjacent pair
+        left = right
+        right += font.getlength(prev + ch) - font.getlength(prev)
+        prev = ch
+        box = None
+        if not ch.isspace():
+            box = draw.textbbox((left, top), ch, font=font)
+        if not box or box[0] >= box[2]:
+            box = (left, top, right, bottom)
+        boxes.append((ch, box))
+    # a tab ends the text line
+    boxes.append(('\t', (right, top, right + 1, bottom)))
+    return im, boxes
+
+
+def layout_vertical(text, font, size, xsize, ysize, margin, glyph_map):
+    # CJK characters upright, the others sideways
+    ascent, descent = font.getmetrics()
+    cells = []
+    for ch in text:
+        if ch.isspace():
+            cells.append((ch, None, False, size // 2))
+            continue
+        glyph = glyph_map.get(ch, ch)
+        if unicodedata.east_asian_width(glyph) in 'WF':
+            cells.append((ch, glyph, True, size))
+        else:
+            cells.append((ch, glyph, False, math.ceil(font.getlength(glyph))))
+    height = sum(cell[3] for cell in cells) + margin * 2
+    if height > ysize or max(size, ascent + descent) + margin * 2 > xsize:
+        return None, None
+    im = Image.new('L', (xsize, height), 255)
+    draw = ImageDraw.Draw(im)
+    center = xsize // 2
+    boxes = []
+    y = margin
+    for ch, glyph, upright, advance in cells:
+        if glyph is None:
+            box = (center - size // 2, y, center + size // 2, y + advance)
+        elif upright:
+            xy = (center, y + advance / 2)
+            draw.text(xy, glyph, font=font, fill=0, anchor='mm')
+            box = draw.textbbox(xy, glyph, font=font, anchor='mm')
+        else:
+            # rotated clockwise
+            tile = Image.new('L', (advance, ascent + descent), 255)
+            ImageDraw.Draw(tile).text((0, 0), glyph, font=font, fill=0)
+            tile = tile.rotate(-90, expand=True)
+            left = center - tile.width // 2
+            im.paste(tile, (left, y))
+            box = (left, y, left + tile.width, y + advance)
+        boxes.append((ch, box))
+        y += advance
+    boxes.append(('\t', (center - size // 2, y, center + size // 2, y + 1)))
+    return im, boxes
+
+
+def render_line(filename_base, text, font_file, font_index, vertical, dpi,
+                exposure, xsize, ysize, margin=30, glyph_map=None):
+    # Writes filename_base.tif/.box of a single page. Returns False if the
+    # line doesn't fit in the page or the font can't be used.
+    size = round(PT_SIZE * dpi / 72)
+    try:
+        font = load_font(font_file, font_index, size)
+        if vertical:
+            im, boxes = layout_vertical(
+                text, font, size, xsize, ysize, margin, glyph_map or {})
+        else:
+            im, boxes = layout_horizontal(text, font, xsize, ysize, margin)
+    except OSError as ex:
+        print('Render error: %s: %s' % (font_file, ex))
+        return False
+    if im is None:
+        return False
+    threshold = 128 + exposure * EXPOSURE_STEP
+    im = im.point([0 if x < threshold else 255 for x in range(256)], '1')
+    im.save(filename_base + '.tif', compression='group4', dpi=(dpi, dpi))
+    with open(filename_base + '.box', 'w', encoding='utf-8') as f:
+        for ch, (left, top, right, bottom) in boxes:
+            # tesseract boxes start from the bottom, and like text2image
+            # a space is written as itself
+            f.write('%s %d %d %d %d 0\n' % (
+                ch, round(left), im.height - round(bottom),
+                round(right), im.height - round(top)))
+    return True